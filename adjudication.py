@@ -0,0 +1,68 @@
+# resign/draw adjudication and a max ply cap for self-play games
+# same rules as c-chess-cli's -resign count=N score=S and -draw count=N score=S
+import chess
+
+# reasons a game was adjudicated, in the order they are reported
+REASONS = ["resign", "draw", "max_ply"]
+
+class Adjudication:
+    # resign: the mover's own score was <= -resign_score for resign_count of its moves in a row
+    # draw: both sides' scores were within draw_score for draw_count moves each in a row
+    # counting starts at start_ply (self-play's random opening phase is left alone)
+    # and draws need at least draw_ply plies, a count of 0 turns a rule off
+    def __init__(self, resign_count=0, resign_score=700, draw_count=0, draw_score=10, draw_ply=0, max_ply=0, start_ply=0):
+        self.resign_count = resign_count
+        self.resign_score = resign_score
+        self.draw_count = draw_count
+        self.draw_score = draw_score
+        self.draw_ply = draw_ply
+        self.max_ply = max_ply
+        self.start_ply = start_ply
+
+    def enabled(self) -> bool:
+        return bool(self.resign_count or self.draw_count or self.max_ply)
+
+    def new_game(self) -> "GameAdjudication":
+        return GameAdjudication(self)
+
+# adjudication state of a single game
+class GameAdjudication:
+    def __init__(self, rules):
+        self.rules = rules
+        self.resign_streak = {chess.WHITE: 0, chess.BLACK: 0}
+        self.draw_streak = 0
+
+    # check the game after a move was pushed with its search score
+    # returns (reason, result) once the game is adjudicated, else None
+    # a move that ended the game (mate, stalemate, a draw that can be claimed)
+    # is never adjudicated, the game is scored as played
+    def update(self, board, povscore):
+        verdict = self.rule_verdict(board, povscore)
+        # claimable draws replay the move stack, so only look once a rule fires
+        if verdict and board.is_game_over(claim_draw=True):
+            return None
+        return verdict
+
+    def rule_verdict(self, board, povscore):
+        rules = self.rules
+        ply = board.ply()
+        mover = not board.turn
+
+        if rules.max_ply and ply >= rules.max_ply:
+            return "max_ply", None
+        if ply < rules.start_ply:
+            return None
+
+        score = povscore.pov(mover).score(mate_score=32000)
+
+        if rules.resign_count:
+            self.resign_streak[mover] = self.resign_streak[mover] + 1 if score <= -rules.resign_score else 0
+            if self.resign_streak[mover] >= rules.resign_count:
+                return "resign", "0-1" if mover == chess.WHITE else "1-0"
+
+        if rules.draw_count:
+            self.draw_streak = self.draw_streak + 1 if abs(score) <= rules.draw_score else 0
+            if self.draw_streak >= 2 * rules.draw_count and ply >= rules.draw_ply:
+                return "draw", "1/2-1/2"
+
+        return None
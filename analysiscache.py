@@ -0,0 +1,118 @@
+# cache of engine analyses for positions self-play reaches over and over
+# (book exits, early-game positions), keyed on the zobrist hash and the
+# search settings, with an lru in memory and an optional sqlite store
+# shared across runs and workers
+# every key starts with a fingerprint of the engine and its uci options, so a
+# store shared by runs of other engines or nets never returns their evaluations
+import collections
+import hashlib
+import json
+import os.path
+import sqlite3
+import chess
+import chess.engine
+import chess.polyglot
+
+# entries kept in memory when only a store is given
+DEFAULT_SIZE = 100000
+
+# store writes per commit
+COMMIT_EVERY = 1000
+
+# engine path and sorted uci options, EvalFile (the net) as an absolute path
+def engine_fingerprint(engine, options=None) -> str:
+    options = dict(options or {})
+    if options.get("EvalFile"):
+        options["EvalFile"] = os.path.abspath(options["EvalFile"])
+    settings = json.dumps([os.path.abspath(engine), sorted(options.items())])
+    return hashlib.sha1(settings.encode()).hexdigest()[:16]
+
+# cache key of a search, repetition history is not part of it
+def search_key(board, limit, multipv, root_moves, fingerprint="") -> str:
+    moves = ",".join(sorted(move.uci() for move in root_moves)) if root_moves else "-"
+    return f"{fingerprint} {chess.polyglot.zobrist_hash(board):016x} {limit.nodes or 0} {limit.depth or 0} {multipv} {moves}"
+
+# store format: per pv the relative cp, relative mate, pv moves, nodes, depth, time
+def encode_results(results) -> str:
+    return json.dumps([[info["score"].relative.score(), info["score"].relative.mate(), [move.uci() for move in info.get("pv", [])], info.get("nodes", 0), info.get("depth", 0), info.get("time", 0.0)] for info in results])
+
+def decode_results(data, turn) -> list:
+    results = []
+    for cp, mate, pv, nodes, depth, time in json.loads(data):
+        score = chess.engine.Mate(mate) if mate != None else chess.engine.Cp(cp)
+        results.append({"score": chess.engine.PovScore(score, turn), "pv": [chess.Move.from_uci(move) for move in pv], "nodes": nodes, "depth": depth, "time": time})
+    return results
+
+class AnalysisCache:
+    def __init__(self, size=DEFAULT_SIZE, file_name=None, fingerprint=""):
+        self.size = size
+        self.fingerprint = fingerprint
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.store = None
+        self.pending = 0
+
+        if file_name:
+            # wal lets several workers read while one writes
+            self.store = sqlite3.connect(file_name, timeout=60)
+            self.store.execute("PRAGMA journal_mode = WAL")
+            self.store.execute("PRAGMA synchronous = NORMAL")
+            self.store.execute("CREATE TABLE IF NOT EXISTS analysis (key TEXT PRIMARY KEY, results TEXT)")
+            self.store.commit()
+
+    # cached multipv results of the search, None on a miss
+    def get(self, board, limit, multipv, root_moves):
+        key = search_key(board, limit, multipv, root_moves, self.fingerprint)
+        results = self.entries.get(key)
+        if results != None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return results
+
+        if self.store != None:
+            row = self.store.execute("SELECT results FROM analysis WHERE key = ?", (key,)).fetchone()
+            if row != None:
+                results = decode_results(row[0], board.turn)
+                self.remember(key, results)
+                self.store_hits += 1
+                return results
+
+        self.misses += 1
+        return None
+
+    def put(self, board, limit, multipv, root_moves, results) -> None:
+        key = search_key(board, limit, multipv, root_moves, self.fingerprint)
+        self.remember(key, results)
+        if self.store != None:
+            self.store.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?)", (key, encode_results(results)))
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.store.commit()
+                self.pending = 0
+
+    # add to the lru, evicting the least recently used entry
+    def remember(self, key, results) -> None:
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def summary(self) -> str:
+        lookups = self.hits + self.store_hits + self.misses
+        ratio = round((self.hits + self.store_hits) / lookups * 100, 2) if lookups else 0.0
+        return f"analysis cache: {self.hits + self.store_hits} of {lookups} searches skipped ({ratio}%), {self.store_hits} from the store, {len(self.entries)} entries in memory"
+
+    def close(self) -> None:
+        if self.store != None:
+            self.store.commit()
+            self.store.close()
+            self.store = None
+
+# build a cache from the cli options, None when disabled
+# fingerprint is the engine_fingerprint() of the engine that fills it
+def open_cache(size=0, file_name=None, fingerprint=""):
+    if not size and not file_name:
+        return None
+    return AnalysisCache(size or DEFAULT_SIZE, file_name, fingerprint)
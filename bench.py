@@ -0,0 +1,179 @@
+# self-play throughput benchmark
+# runs fixed workloads against the deterministic mockuci.py engine, so the
+# numbers only move when the python side of self-play does
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import os.path
+import random
+import resource
+import sys
+import tempfile
+import time
+import chess
+import chess.pgn
+import bookindex
+import metrics as metrics_stage
+import selfplay
+
+MOCK_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mockuci.py")
+DEFAULT_BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "books", "unbal4moves.bin")
+
+WORKLOADS = ["play-pgn", "play-plain", "play-bin", "parse-plain", "parse-bin", "book"]
+
+# games played by the mock engine, shared by the parse and book workloads
+def reference_games(options) -> list:
+    random.seed(options["seed"])
+    pgn_name = os.path.join(options["directory"], "reference.pgn")
+    if not os.path.exists(pgn_name):
+        book_reader = bookindex.BookIndex(options["book"]) if options["book"] else None
+        selfplay.play(options["games"], options["engine"], file_type="pgn", nodes=options["nodes"], depth=0, multipv=options["multipv"], mode=options["mode"], file_name=pgn_name, book_reader=book_reader, min_ply=options["min_ply"])
+    games = []
+    with open(pgn_name) as pgn_file:
+        while True:
+            game = chess.pgn.read_game(pgn_file)
+            if game == None:
+                break
+            games.append(game)
+    return games
+
+# play games with the mock engine and write them in file_type
+def bench_play(options, file_type) -> tuple:
+    random.seed(options["seed"])
+    file_name = os.path.join(options["directory"], f"bench.{file_type}")
+    book_reader = bookindex.BookIndex(options["book"]) if options["book"] else None
+    metrics = metrics_stage.Metrics()
+    selfplay.play(options["games"], options["engine"], file_type=file_type, nodes=options["nodes"], depth=0, multipv=options["multipv"], mode=options["mode"], file_name=file_name, book_reader=book_reader, min_ply=options["min_ply"], metrics=metrics)
+    return options["games"], metrics.positions
+
+# convert finished game trees to trainer records, no engine involved
+def bench_parse(options, file_type) -> tuple:
+    games = reference_games(options)
+    start = time.perf_counter()
+    positions = 0
+    for _ in range(options["repeat"]):
+        for game in games:
+            writer = io.BytesIO() if file_type == "bin" else io.StringIO()
+            selfplay.parse_game(game, writer, options["min_ply"], file_type)
+            positions += game.end().ply()
+    return len(games) * options["repeat"], positions, time.perf_counter() - start
+
+# probe the book along the opening of every game
+def bench_book(options) -> tuple:
+    games = reference_games(options)
+    book_reader = bookindex.BookIndex(options["book"])
+    start = time.perf_counter()
+    positions = 0
+    for _ in range(options["repeat"]):
+        for game in games:
+            book = book_reader.new_game()
+            board = game.board()
+            for move in game.mainline_moves():
+                book.probe(board)
+                positions += 1
+                if not book.in_book:
+                    break
+                board.push(move)
+    book_reader.close()
+    return len(games) * options["repeat"], positions, time.perf_counter() - start
+
+# run one workload, in its own process so its peak rss is its own
+def run_workload(task) -> dict:
+    name, options = task
+    start = time.perf_counter()
+    if name.startswith("play-"):
+        games, positions = bench_play(options, name[5:])
+        seconds = time.perf_counter() - start
+    elif name.startswith("parse-"):
+        games, positions, seconds = bench_parse(options, name[6:])
+    else:
+        games, positions, seconds = bench_book(options)
+
+    seconds = max(seconds, 1e-9)
+    return {
+        "workload": name,
+        "games": games,
+        "positions": positions,
+        "seconds": round(seconds, 4),
+        "games_per_second": round(games / seconds, 2),
+        "positions_per_second": round(positions / seconds, 1),
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "engine_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--nodes", type=int, default=1)
+    parser.add_argument("--multipv", type=int, default=10)
+    parser.add_argument("--mode", type=str, default="random", choices=["softmax", "random", "random-multipv"])
+    parser.add_argument("--min_ply", type=int, default=15)
+    parser.add_argument("--book", type=str, default=DEFAULT_BOOK)
+    parser.add_argument("--engine", type=str, default=MOCK_ENGINE, help="uci engine, the deterministic mock by default")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the reference games in the parse and book workloads")
+    parser.add_argument("--workload", type=str, nargs="+", default=WORKLOADS, choices=WORKLOADS)
+    parser.add_argument("--output", type=str, help="write the results as json")
+    parser.add_argument("--baseline", type=str, help="json results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed positions/s drop against the baseline")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="selfplay-bench-")
+    options = {
+        "games": args.games,
+        "nodes": args.nodes,
+        "multipv": args.multipv,
+        "mode": args.mode,
+        "min_ply": args.min_ply,
+        "book": args.book if args.book and os.path.exists(args.book) else None,
+        "engine": args.engine,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "directory": directory,
+    }
+    if "book" in args.workload and options["book"] == None:
+        parser.error("the book workload needs --book")
+
+    print(f"ENGINE:", args.engine)
+    print(f"BOOK:", options["book"])
+    print(f"GAMES:", args.games, f"NODES:", args.nodes, f"MULTIPV:", args.multipv, f"MODE:", args.mode)
+
+    # the reference games are played once, up front, so no workload pays for them
+    reference_games(options)
+
+    results = []
+    for name in args.workload:
+        with multiprocessing.Pool(1) as pool:
+            result = pool.map(run_workload, [(name, options)])[0]
+        results.append(result)
+        print(f"{name:12s} {result['games_per_second']:10.2f} games/s {result['positions_per_second']:12.1f} positions/s {result['peak_rss_mb']:8.1f} MB peak rss")
+
+    for file_name in os.listdir(directory):
+        os.remove(os.path.join(directory, file_name))
+    os.rmdir(directory)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = {result["workload"]: result for result in json.load(baseline_file)}
+        regressions = 0
+        for result in results:
+            reference = baseline.get(result["workload"])
+            if reference == None:
+                continue
+            change = result["positions_per_second"] / reference["positions_per_second"] - 1
+            print(f"{result['workload']:12s} {change * 100:+.1f}% against the baseline")
+            if change < -args.tolerance:
+                regressions += 1
+        if regressions:
+            print(f"regressions:", regressions)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# in-memory index of a polyglot opening book for the self-play probe
+import array
+import bisect
+import mmap
+import os
+import random
+import struct
+# libraries for zobrist keys and moves
+import chess
+import chess.polyglot
+
+# polyglot entry: key, move, weight, learn (big endian, 16 bytes)
+ENTRY = struct.Struct(">QHHI")
+
+# polyglot stores castling as king takes rook
+CASTLING_MOVES = {
+    (chess.E1, chess.H1): chess.G1,
+    (chess.E1, chess.A1): chess.C1,
+    (chess.E8, chess.H8): chess.G8,
+    (chess.E8, chess.A8): chess.C8,
+}
+
+# the book file is memory-mapped and its sorted keys are loaded once,
+# the move table of a position is decoded on its first probe and cached
+class BookIndex:
+    def __init__(self, file_name, weighted=False, minimum_weight=1):
+        self.weighted = weighted
+        self.minimum_weight = minimum_weight
+        self.file = open(file_name, "rb")
+        self.data = None
+        self.keys = array.array("Q")
+        self.tables = {}
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size >= ENTRY.size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            with memoryview(self.data) as view:
+                self.keys.extend(entry[0] for entry in ENTRY.iter_unpack(view[:size - size % ENTRY.size]))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    # (from, to, promotion) moves and their weights for a zobrist key
+    def table(self, key) -> tuple:
+        table = self.tables.get(key)
+        if table != None:
+            return table
+
+        moves = []
+        weights = []
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            _, raw_move, weight, _ = ENTRY.unpack_from(self.data, i * ENTRY.size)
+            i += 1
+            if weight < self.minimum_weight:
+                continue
+            promotion = (raw_move >> 12) & 0x7
+            moves.append(((raw_move >> 6) & 0x3f, raw_move & 0x3f, promotion + 1 if promotion else None))
+            weights.append(weight)
+
+        table = (moves, weights)
+        self.tables[key] = table
+        return table
+
+    # legal book moves for the board and their weights
+    def find(self, board) -> tuple:
+        moves, weights = self.table(chess.polyglot.zobrist_hash(board))
+
+        legal_moves = []
+        legal_weights = []
+        for (from_square, to_square, promotion), weight in zip(moves, weights):
+            if board.piece_type_at(from_square) == chess.KING:
+                to_square = CASTLING_MOVES.get((from_square, to_square), to_square)
+            move = chess.Move(from_square, to_square, promotion)
+            if board.is_legal(move):
+                legal_moves.append(move)
+                legal_weights.append(weight)
+
+        return legal_moves, legal_weights
+
+    # pick a book move for the board, None if the position is not in the book
+    def pick(self, board):
+        moves, weights = self.find(board)
+        if moves == []:
+            return None
+        if self.weighted:
+            return random.choices(moves, weights=weights)[0]
+        return random.choice(moves)
+
+    # track a new game, probing stops once it leaves the book
+    def new_game(self) -> "BookGame":
+        return BookGame(self)
+
+    def close(self) -> None:
+        if self.data != None:
+            self.data.close()
+        self.file.close()
+
+# book state of a single game
+class BookGame:
+    def __init__(self, index):
+        self.index = index
+        self.in_book = True
+
+    # book move for the board, None once the game is out of book
+    def probe(self, board):
+        if not self.in_book:
+            return None
+        move = self.index.pick(board)
+        if move == None:
+            self.in_book = False
+        return move
@@ -0,0 +1,112 @@
+# checkpoint journal of a resumable self-play run
+# after a flush of the output, the finished rounds, the counters, the rng state
+# and the size of every output file go to <output>.checkpoint, which is
+# replaced atomically so the checkpoint itself is never torn
+# a checkpoint only counts games whose flush is done, so resuming cuts the
+# output back to the checkpointed sizes (a torn last game and whatever was
+# written after the checkpoint go) and plays the rounds that aren't finished
+import json
+import os
+import os.path
+import random
+import adjudication as adjudication_stage
+
+# settings and output of a run, in its run directory
+RUN_FILE = "run.json"
+
+def checkpoint_name(file_name) -> str:
+    return file_name + ".checkpoint"
+
+# the checkpoint of an output, None if there is none
+def read_checkpoint(file_name):
+    if not os.path.exists(checkpoint_name(file_name)):
+        return None
+    with open(checkpoint_name(file_name)) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def write_checkpoint(file_name, checkpoint) -> None:
+    temporary_name = checkpoint_name(file_name) + ".tmp"
+    with open(temporary_name, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temporary_name, checkpoint_name(file_name))
+
+# a finished run has nothing to resume, its checkpoint goes
+def remove_checkpoint(file_name) -> None:
+    if os.path.exists(checkpoint_name(file_name)):
+        os.remove(checkpoint_name(file_name))
+
+def read_run(run_dir) -> dict:
+    with open(os.path.join(run_dir, RUN_FILE)) as run_file:
+        return json.load(run_file)
+
+# args are the parsed command line, file_name the output the run writes
+def write_run(run_dir, args, file_name, finished=False) -> None:
+    temporary_name = os.path.join(run_dir, RUN_FILE + ".tmp")
+    with open(temporary_name, "w") as run_file:
+        json.dump({"args": vars(args), "output": os.path.basename(file_name), "finished": finished}, run_file, indent=1)
+    os.replace(temporary_name, os.path.join(run_dir, RUN_FILE))
+
+# finished rounds and counters of the games played into an output sink
+class Journal:
+    def __init__(self, file_name, output, first_round=1):
+        self.file_name = file_name
+        self.output = output
+        # every round before `through` is finished, with --concurrency games finish
+        # out of order and the ones after it are kept in `rounds`
+        self.through = first_round
+        self.rounds = set()
+        self.counters = (0, 0, 0, {reason: 0 for reason in adjudication_stage.REASONS})
+        self.flushes = output.flushes
+        output.checkpointed = True
+
+    # pick up from the checkpoint of an earlier run, or write the first one
+    # returns the (white_wins, black_wins, draws, adjudicated) counters so far
+    def resume(self) -> tuple:
+        checkpoint = read_checkpoint(self.file_name)
+        if checkpoint == None:
+            self.write()
+            return self.counters
+
+        self.output.restore(checkpoint["output"])
+        self.through = checkpoint["through"]
+        self.rounds = set(checkpoint["rounds"])
+        self.counters = (checkpoint["white_wins"], checkpoint["black_wins"], checkpoint["draws"], checkpoint["adjudicated"])
+        version, state, gauss_next = checkpoint["random"]
+        random.setstate((version, tuple(state), gauss_next))
+        print(f"RESUME:", f"{self.games()} games of {self.file_name} already played")
+        return self.counters
+
+    def games(self) -> int:
+        return sum(self.counters[:3])
+
+    def is_finished(self, round_number) -> bool:
+        return round_number < self.through or round_number in self.rounds
+
+    # a game went through output.end_game(), checkpoint if the output was flushed
+    def add(self, round_number, white_wins, black_wins, draws, adjudicated) -> None:
+        self.rounds.add(round_number)
+        while self.through in self.rounds:
+            self.rounds.remove(self.through)
+            self.through += 1
+        self.counters = (white_wins, black_wins, draws, dict(adjudicated))
+        self.sync()
+
+    # checkpoint if the output was flushed since the last checkpoint
+    # only call it once every game the flush held went through add()
+    def sync(self) -> None:
+        if self.output.flushes != self.flushes:
+            self.flushes = self.output.flushes
+            self.write()
+
+    def write(self) -> None:
+        white_wins, black_wins, draws, adjudicated = self.counters
+        write_checkpoint(self.file_name, {
+            "through": self.through,
+            "rounds": sorted(self.rounds),
+            "white_wins": white_wins,
+            "black_wins": black_wins,
+            "draws": draws,
+            "adjudicated": adjudicated,
+            "random": random.getstate(),
+            "output": self.output.state(),
+        })
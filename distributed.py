@@ -0,0 +1,240 @@
+# distributed self-play over plain tcp
+# the coordinator (selfplay.py --serve) cuts the run into batches of games and
+# hands them out with a seed, the first round and the run's settings, workers
+# (selfplay.py --connect) stream every finished game back as it's written
+# a batch is only committed to the output once its worker finished it, so a
+# lost worker's batch goes back to the queue without leaving half of it behind
+# after every commit the done batches and the counters are checkpointed, a
+# coordinator started on an output that has a checkpoint plays on from there,
+# the checkpoint is removed once every batch is committed
+import collections
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+import adjudication as adjudication_stage
+import checkpoint
+import sink
+
+# a frame is the length of its json header, the header, then header["size"] payload bytes
+LENGTH = struct.Struct(">I")
+
+# "host:port" -> (host, port)
+def parse_address(address) -> tuple:
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+def send_frame(connection, header, payload=b"") -> None:
+    data = json.dumps(dict(header, size=len(payload))).encode()
+    connection.sendall(LENGTH.pack(len(data)) + data + payload)
+
+def receive_exactly(connection, size) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+# returns (header, payload)
+def receive_frame(connection) -> tuple:
+    length = LENGTH.unpack(receive_exactly(connection, LENGTH.size))[0]
+    header = json.loads(receive_exactly(connection, length))
+    return header, receive_exactly(connection, header["size"])
+
+# batches, their state and the output of a distributed run
+class Coordinator:
+    def __init__(self, games, batch_games, settings, file_name, file_type, seed=0, timeout=600):
+        self.settings = settings
+        self.file_name = file_name
+        self.file_type = file_type
+        self.seed = seed
+        self.timeout = timeout
+        # (games, first round) of every batch
+        self.batches = []
+        for first_round in range(1, games + 1, batch_games):
+            self.batches.append((min(batch_games, games - first_round + 1), first_round))
+        self.pending = collections.deque(range(len(self.batches)))
+        self.done = set()
+        self.workers = set()
+        self.condition = threading.Condition()
+        # commit() flushes a batch at once, never a game at a time
+        self.output = sink.OutputSink(file_name, file_type, float("inf"))
+        self.output.checkpointed = True
+        self.white_wins = 0
+        self.black_wins = 0
+        self.draws = 0
+        self.adjudicated = {reason: 0 for reason in adjudication_stage.REASONS}
+        self.start = time.perf_counter()
+
+        # the output is cut back to the checkpoint, the done batches aren't handed out again
+        previous = checkpoint.read_checkpoint(file_name)
+        if previous:
+            assert previous["batches"] == len(self.batches), "The checkpoint is of a run with other batches."
+            self.output.restore(previous["output"])
+            self.done = set(previous["done"])
+            self.pending = collections.deque(batch for batch in range(len(self.batches)) if batch not in self.done)
+            self.white_wins = previous["white_wins"]
+            self.black_wins = previous["black_wins"]
+            self.draws = previous["draws"]
+            self.adjudicated = previous["adjudicated"]
+            print(f"RESUME:", f"{len(self.done)} of {len(self.batches)} batches already played")
+        self.played_before = self.white_wins + self.black_wins + self.draws
+
+    def is_finished(self) -> bool:
+        return len(self.done) == len(self.batches)
+
+    # the next batch to hand out, waits while others are in flight
+    # (they come back if their worker is lost), None once all are done
+    def take(self):
+        with self.condition:
+            while True:
+                if self.pending:
+                    return self.pending.popleft()
+                if self.is_finished():
+                    return None
+                self.condition.wait(1)
+
+    # a batch of a lost worker goes back to the front of the queue
+    def release(self, batch) -> None:
+        with self.condition:
+            self.pending.appendleft(batch)
+            self.condition.notify_all()
+
+    def batch_message(self, batch) -> dict:
+        games, first_round = self.batches[batch]
+        return dict(self.settings, type="batch", batch=batch, games=games, first_round=first_round, seed=self.seed + batch)
+
+    # write the games of a finished batch, then checkpoint
+    def commit(self, batch, games, counters, adjudicated, worker) -> None:
+        with self.condition:
+            for game in games:
+                self.output.write(game.decode() if self.file_type in ["pgn", "plain"] else game)
+                self.output.end_game()
+            self.output.flush()
+            self.white_wins += counters[0]
+            self.black_wins += counters[1]
+            self.draws += counters[2]
+            for reason in self.adjudicated:
+                self.adjudicated[reason] += adjudicated.get(reason, 0)
+            self.done.add(batch)
+            self.write_checkpoint()
+            self.condition.notify_all()
+
+            played = self.white_wins + self.black_wins + self.draws
+            elapsed = time.perf_counter() - self.start
+            print(f"batch {batch} from {worker}: {len(self.done)} of {len(self.batches)} batches, {played} games, "
+                  f"{round((played - self.played_before) / elapsed, 2)} games/s over {len(self.workers)} workers")
+
+    # the checkpoint never counts a game that isn't on disk, it's written after the flush
+    def write_checkpoint(self) -> None:
+        checkpoint.write_checkpoint(self.file_name, {
+            "batches": len(self.batches),
+            "done": sorted(self.done),
+            "white_wins": self.white_wins,
+            "black_wins": self.black_wins,
+            "draws": self.draws,
+            "adjudicated": self.adjudicated,
+            "output": self.output.state(),
+        })
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        coordinator = self.server.coordinator
+        connection = self.request
+        # a worker sends a frame per game, silence for this long means it's gone
+        connection.settimeout(coordinator.timeout)
+        batch = None
+        worker = str(self.client_address)
+        try:
+            header, _ = receive_frame(connection)
+            worker = header.get("name", worker)
+            coordinator.workers.add(worker)
+            print(f"worker {worker} connected")
+
+            while True:
+                batch = coordinator.take()
+                if batch == None:
+                    send_frame(connection, {"type": "done"})
+                    return
+                send_frame(connection, coordinator.batch_message(batch))
+
+                games = []
+                while True:
+                    header, payload = receive_frame(connection)
+                    if header["type"] == "game":
+                        games.append(payload)
+                    elif header["type"] == "finished":
+                        break
+                coordinator.commit(batch, games, header["counters"], header["adjudicated"], worker)
+                batch = None
+        except (OSError, ValueError) as error:
+            print(f"worker {worker} lost: {error}")
+        finally:
+            coordinator.workers.discard(worker)
+            if batch != None:
+                print(f"batch {batch} goes back to the queue")
+                coordinator.release(batch)
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+# serve batches until every game is played, returns the (white_wins, black_wins, draws, adjudicated) counters
+def serve(address, games, batch_games, settings, file_name, file_type, seed=0, timeout=600) -> tuple:
+    coordinator = Coordinator(games, batch_games, settings, file_name, file_type, seed, timeout)
+    server = CoordinatorServer(address, WorkerHandler)
+    server.coordinator = coordinator
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"serving {len(coordinator.batches)} batches on", f"{address[0]}:{address[1]}")
+
+    try:
+        with coordinator.condition:
+            while not coordinator.is_finished():
+                coordinator.condition.wait(1)
+    finally:
+        server.shutdown()
+        server.server_close()
+        coordinator.output.close()
+
+    # every batch is committed, an interrupted run keeps its checkpoint to resume from
+    checkpoint.remove_checkpoint(file_name)
+    return coordinator.white_wins, coordinator.black_wins, coordinator.draws, coordinator.adjudicated
+
+# output sink of a worker, every finished game goes to the coordinator in a frame
+class SocketSink:
+    def __init__(self, connection, batch):
+        self.connection = connection
+        self.batch = batch
+        self.buffer = []
+
+    def write(self, record) -> None:
+        self.buffer.append(record.encode() if isinstance(record, str) else record)
+
+    def end_game(self) -> None:
+        send_frame(self.connection, {"type": "game", "batch": self.batch}, b"".join(self.buffer))
+        self.buffer = []
+
+    def close(self) -> None:
+        if self.buffer:
+            self.end_game()
+
+# play batches for a coordinator until it's done
+# play_batch(batch, output) plays the batch message's games into output and returns the counters
+def run_worker(address, name, play_batch) -> None:
+    connection = socket.create_connection(address)
+    send_frame(connection, {"type": "hello", "name": name})
+    batches = 0
+    while True:
+        header, _ = receive_frame(connection)
+        if header["type"] == "done":
+            break
+        white_wins, black_wins, draws, adjudicated = play_batch(header, SocketSink(connection, header["batch"]))
+        send_frame(connection, {"type": "finished", "batch": header["batch"], "counters": [white_wins, black_wins, draws], "adjudicated": adjudicated})
+        batches += 1
+    connection.close()
+    print(f"worker {name}: {batches} batches played")
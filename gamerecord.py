@@ -0,0 +1,64 @@
+# compact record of a self-play game: move codes and scores in flat arrays
+# instead of a chess.pgn tree with a node and an eval comment per move
+# the tree is only built when the game is written as pgn
+import array
+import chess
+import chess.engine
+
+# scores are white centipawns, mates are stored like python-chess's mate_score
+# so a mate in n is MATE_SCORE - n, and the sign is the side that mates
+MATE_SCORE = 32000
+MAX_MATE = 1000
+
+# from and to square in 6 bits each, the promotion piece type above them
+def encode_move(move) -> int:
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def decode_move(code) -> chess.Move:
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+def encode_score(povscore) -> int:
+    return povscore.white().score(mate_score=MATE_SCORE)
+
+def decode_score(score) -> chess.engine.PovScore:
+    if score >= MATE_SCORE - MAX_MATE:
+        return chess.engine.PovScore(chess.engine.Mate(MATE_SCORE - score), chess.WHITE)
+    if score <= MAX_MATE - MATE_SCORE:
+        return chess.engine.PovScore(chess.engine.Mate(-MATE_SCORE - score), chess.WHITE)
+    return chess.engine.PovScore(chess.engine.Cp(score), chess.WHITE)
+
+class GameRecord:
+    __slots__ = ["engine", "round_number", "moves", "scores", "result", "adjudicated"]
+
+    def __init__(self, engine, round_number):
+        self.engine = engine
+        self.round_number = round_number
+        self.moves = array.array("H")
+        self.scores = array.array("i")
+        self.result = None
+        self.adjudicated = False
+
+    # a move and the score of the search that picked it
+    def add(self, move, povscore) -> None:
+        self.moves.append(encode_move(move))
+        self.scores.append(encode_score(povscore))
+
+    def ply(self) -> int:
+        return len(self.moves)
+
+    def move(self, index) -> chess.Move:
+        return decode_move(self.moves[index])
+
+    def score(self, index) -> chess.engine.PovScore:
+        return decode_score(self.scores[index])
+
+    # fill a game tree that has its tag roster with the moves, evals and result
+    def to_game(self, game):
+        node = game
+        for index in range(len(self.moves)):
+            node = node.add_main_variation(self.move(index))
+            node.set_eval(self.score(index))
+        game.headers["Result"] = self.result
+        if self.adjudicated:
+            game.headers["Termination"] = "adjudication"
+        return game
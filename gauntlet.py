@@ -0,0 +1,331 @@
+# gauntlet of candidate nets against a baseline net with sprt early stopping
+# every pairing plays opening pairs (one opening with both colours) on a shared
+# asyncio engine pool, nets are switched with the EvalFile option and a pairing
+# stops as soon as its sprt accepts elo0 or elo1, or at --max_games
+import argparse
+import asyncio
+import glob
+import math
+import os
+import os.path
+import random
+import sys
+import time
+import chess
+import chess.engine
+import chess.pgn
+import bookindex
+import adjudication as adjudication_stage
+import selfplay
+# nnue trainer formats
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nnue"))
+import sink
+
+# expected score of the side that is elo stronger, logistic elo
+def expected_score(elo) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+def score_to_elo(score) -> float:
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+# results and sprt state of one candidate net against the baseline
+class Pairing:
+    def __init__(self, net, elo0=-20, elo1=20, alpha=0.05, beta=0.05, max_games=200):
+        self.net = net
+        self.name = os.path.basename(net)
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.max_pairs = max(1, max_games // 2)
+        # the sprt stops once the log likelihood ratio leaves (lower, upper)
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        # opening pairs by the candidate's points in them, 0, 0.5, ... 2
+        self.pairs = [0] * 5
+        self.wins = 0
+        self.losses = 0
+        self.draws = 0
+        self.scheduled = 0
+        self.status = None
+
+    def games(self) -> int:
+        return self.wins + self.losses + self.draws
+
+    # can more pairs be handed out
+    def is_open(self) -> bool:
+        return self.status == None and self.scheduled < self.max_pairs
+
+    # the candidate's score of a game, 1, 0.5 or 0
+    def add_game(self, score) -> None:
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    # the candidate's scores of both games of a pair, decides the test when it can
+    def add_pair(self, scores) -> None:
+        self.pairs[int(sum(scores) * 2)] += 1
+        if self.status != None:
+            return
+        llr = self.llr()
+        if llr >= self.upper:
+            self.status = "H1"
+        elif llr <= self.lower:
+            self.status = "H0"
+        elif sum(self.pairs) >= self.max_pairs:
+            self.status = "max_games"
+
+    # pairs, mean and variance of the pair scores scaled to 0..1
+    def stats(self) -> tuple:
+        pairs = sum(self.pairs)
+        mean = sum(count * points / 4 for points, count in enumerate(self.pairs)) / pairs
+        variance = sum(count * (points / 4 - mean) ** 2 for points, count in enumerate(self.pairs)) / pairs
+        return pairs, mean, variance
+
+    # generalized sprt on the pentanomial distribution of the pairs (the normal
+    # approximation fishtest uses), 0 while there's no variance to go on
+    def llr(self) -> float:
+        if sum(self.pairs) < 2:
+            return 0.0
+        pairs, mean, variance = self.stats()
+        if variance == 0:
+            return 0.0
+        s0 = expected_score(self.elo0)
+        s1 = expected_score(self.elo1)
+        return (s1 - s0) * (2 * mean - s0 - s1) * pairs / (2 * variance)
+
+    # elo and its 95% error
+    def elo(self) -> tuple:
+        if sum(self.pairs) == 0:
+            return 0.0, 0.0
+        pairs, mean, variance = self.stats()
+        error = 1.96 * math.sqrt(variance / pairs)
+        return score_to_elo(mean), (score_to_elo(mean + error) - score_to_elo(mean - error)) / 2
+
+    def summary(self) -> str:
+        elo, error = self.elo()
+        return (f"{self.name}: {self.games()} games +{self.wins} -{self.losses} ={self.draws}, "
+                f"elo {elo:.1f} +- {error:.1f}, llr {self.llr():.2f} ({self.lower:.2f}, {self.upper:.2f}) {self.status or 'running'}")
+
+# the open pairing with the fewest pairs handed out, None once all are done
+def next_pairing(pairings):
+    candidates = [pairing for pairing in pairings if pairing.is_open()]
+    if candidates == []:
+        return None
+    return min(candidates, key=lambda pairing: pairing.scheduled)
+
+# .nnue files of the arguments, directories are searched
+def find_nets(names) -> list:
+    nets = []
+    for name in names:
+        if os.path.isdir(name):
+            nets += sorted(glob.glob(os.path.join(name, "*.nnue")))
+        else:
+            nets += sorted(glob.glob(name)) or [name]
+    return nets
+
+# positions of an epd file, full fen lines work too
+def read_openings(file_name) -> list:
+    openings = []
+    with open(file_name) as epd_file:
+        for line in epd_file:
+            fields = line.split(";")[0].split()
+            if len(fields) >= 6 and fields[4].isdigit():
+                openings.append(chess.Board(" ".join(fields[:6])))
+            elif fields:
+                openings.append(chess.Board.from_epd(line)[0])
+    return openings
+
+# start position of a pair: a random epd opening, or book moves up to book_ply
+def pick_opening(openings, book_reader, book_ply) -> chess.Board:
+    if openings:
+        return random.choice(openings).copy()
+    board = chess.Board()
+    if book_reader:
+        book = book_reader.new_game()
+        while board.ply() < book_ply:
+            move = book.probe(board)
+            if move == None:
+                break
+            board.push(move)
+    return board
+
+# "4+0.04" -> (4.0, 0.04)
+def parse_tc(tc) -> tuple:
+    base, _, increment = tc.partition("+")
+    return float(base), float(increment or 0)
+
+# point an engine at a net, None is the engine's default net
+# EvalFile is only sent when it changes, a net load is not free
+async def set_net(protocol, net) -> None:
+    net = net or protocol.options["EvalFile"].default
+    if protocol.config.get("EvalFile") != net:
+        await protocol.configure({"EvalFile": net})
+
+# play a game from the opening, returns (result, adjudication reason, final board)
+# with a time control the clocks are kept here, the engines get them with every search
+async def play_game(white, black, opening, limit, tc, adjudication, game_key) -> tuple:
+    board = opening.copy()
+    clocks = {chess.WHITE: tc[0], chess.BLACK: tc[0]} if tc else None
+    game_adjudication = adjudication.new_game()
+
+    while True:
+        outcome = board.outcome(claim_draw=True)
+        if outcome:
+            return outcome.result(), None, board
+
+        engine = white if board.turn == chess.WHITE else black
+        if clocks:
+            limit = chess.engine.Limit(white_clock=clocks[chess.WHITE], black_clock=clocks[chess.BLACK], white_inc=tc[1], black_inc=tc[1])
+        start = time.perf_counter()
+        result = await engine.play(board, limit, info=chess.engine.INFO_SCORE, game=game_key)
+
+        # a flag fall or a resignation loses
+        loss = "0-1" if board.turn == chess.WHITE else "1-0"
+        if clocks:
+            clocks[board.turn] -= time.perf_counter() - start
+            if clocks[board.turn] < 0:
+                return loss, "time", board
+            clocks[board.turn] += tc[1]
+        if result.resigned or result.move == None:
+            return loss, "resign", board
+
+        board.push(result.move)
+
+        povscore = result.info.get("score")
+        if povscore != None:
+            verdict = game_adjudication.update(board, povscore)
+            if verdict:
+                reason, verdict_result = verdict
+                return verdict_result or selfplay.game_result(board, povscore), reason, board
+
+# keep handing out opening pairs until every pairing is decided
+# a runner checks out a baseline and a candidate engine for a whole pair
+async def runner(pool, pairings, baseline_net, openings, book_reader, book_ply, limit, tc, adjudication, output) -> None:
+    while True:
+        pairing = next_pairing(pairings)
+        if pairing == None:
+            return
+        pairing.scheduled += 1
+        pair_number = pairing.scheduled
+        opening = pick_opening(openings, book_reader, book_ply)
+
+        baseline = await pool.get()
+        candidate = await pool.get()
+        try:
+            await set_net(baseline, baseline_net)
+            await set_net(candidate, pairing.net)
+
+            scores = []
+            for candidate_color in [chess.WHITE, chess.BLACK]:
+                white, black = (candidate, baseline) if candidate_color == chess.WHITE else (baseline, candidate)
+                result, reason, board = await play_game(white, black, opening, limit, tc, adjudication, (pairing.name, pair_number, candidate_color))
+                score = {"1-0": 1, "0-1": 0}.get(result, 0.5)
+                if candidate_color == chess.BLACK:
+                    score = 1 - score
+                pairing.add_game(score)
+                scores.append(score)
+
+                if output:
+                    game = chess.pgn.Game.from_board(board)
+                    game.headers["Event"] = "Gauntlet"
+                    game.headers["Round"] = f"{pair_number}.{len(scores)}"
+                    game.headers["White"] = pairing.name if candidate_color == chess.WHITE else "baseline"
+                    game.headers["Black"] = "baseline" if candidate_color == chess.WHITE else pairing.name
+                    game.headers["Result"] = result
+                    if reason:
+                        game.headers["Termination"] = "adjudication" if reason in adjudication_stage.REASONS else reason
+                    output.write(str(game) + "\n\n")
+                    output.end_game()
+        finally:
+            pool.put_nowait(baseline)
+            pool.put_nowait(candidate)
+
+        decided = pairing.status
+        pairing.add_pair(scores)
+        if pairing.status != decided or pair_number % 10 == 0:
+            print(pairing.summary())
+
+async def run_gauntlet(engine, pairings, baseline_net, options, concurrency, openings, book_reader, book_ply, limit, tc, adjudication, output) -> None:
+    # two engines per game pair in flight
+    pool, protocols = await selfplay.open_engine_pool(engine, 2 * concurrency)
+    try:
+        for protocol in protocols:
+            await protocol.configure(options)
+        await asyncio.gather(*(runner(pool, pairings, baseline_net, openings, book_reader, book_ply, limit, tc, adjudication, output) for _ in range(concurrency)))
+    finally:
+        await selfplay.close_engine_pool(protocols)
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", type=str, default="./sf.master")
+    parser.add_argument("--nets", type=str, nargs="+", required=True, help="candidate .nnue files, or directories of them")
+    parser.add_argument("--baseline", type=str, help="net of the baseline, the engine's default net if not set")
+    parser.add_argument("--option", type=str, nargs="*", default=[], help="uci options of every engine, NAME=VALUE")
+    parser.add_argument("--tc", type=str, default="4+0.04", help="seconds+increment, unless --nodes or --depth is set")
+    parser.add_argument("--nodes", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=16, help="game pairs in flight, each needs two engines")
+    parser.add_argument("--openings", type=str, help="epd file of start positions, picked at random")
+    parser.add_argument("--book", type=str, help="polyglot book to play the openings from instead")
+    parser.add_argument("--book_ply", type=int, default=8)
+    parser.add_argument("--max_games", type=int, default=200, help="games per net if the sprt doesn't stop earlier")
+    # screening bounds, a net some 80 elo off the baseline is decided well within 200 games,
+    # narrower bounds need far more games than --max_games to decide anything
+    parser.add_argument("--elo0", type=float, default=-20)
+    parser.add_argument("--elo1", type=float, default=20)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--resign_count", type=int, default=3)
+    parser.add_argument("--resign_score", type=int, default=700)
+    parser.add_argument("--draw_count", type=int, default=8)
+    parser.add_argument("--draw_score", type=int, default=10)
+    parser.add_argument("--max_ply", type=int, default=0)
+    parser.add_argument("--pgn", type=str, help="write the games here")
+    parser.add_argument("--seed", type=int, help="seed of the opening picks")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    nets = find_nets(args.nets)
+    assert nets, "No nets found."
+    pairings = [Pairing(net, args.elo0, args.elo1, args.alpha, args.beta, args.max_games) for net in nets]
+    options = dict(option.split("=", 1) for option in args.option)
+
+    # a node or depth limit replaces the time control
+    if args.nodes or args.depth:
+        limit = selfplay.make_limit(args.nodes, args.depth)
+        tc = None
+    else:
+        limit = None
+        tc = parse_tc(args.tc)
+
+    openings = read_openings(args.openings) if args.openings else None
+    book_reader = bookindex.BookIndex(args.book) if args.book and not openings else None
+    adjudication = adjudication_stage.Adjudication(args.resign_count, args.resign_score, args.draw_count, args.draw_score, 0, args.max_ply)
+    output = sink.OutputSink(args.pgn, "pgn") if args.pgn else None
+
+    print(f"ENGINE:", args.engine)
+    print(f"BASELINE:", args.baseline or "default net")
+    print(f"NETS:", len(nets))
+    print(f"LIMIT:", f"tc {args.tc}" if tc else limit)
+    print(f"SPRT:", f"elo0 {args.elo0}, elo1 {args.elo1}, alpha {args.alpha}, beta {args.beta}, at most {args.max_games} games")
+
+    try:
+        asyncio.run(run_gauntlet(args.engine, pairings, args.baseline, options, max(1, args.concurrency), openings, book_reader, args.book_ply, limit, tc, adjudication, output))
+    finally:
+        if output:
+            output.close()
+        if book_reader:
+            book_reader.close()
+
+    # strongest first
+    print(f"Results:")
+    for pairing in sorted(pairings, key=lambda pairing: -pairing.elo()[0]):
+        print(pairing.summary())
+    games = sum(pairing.games() for pairing in pairings)
+    print(f"games played: {games} of {len(pairings) * args.max_games} ({round(games / (len(pairings) * args.max_games) * 100, 1)}%)")
+
+if __name__ == "__main__":
+    main()
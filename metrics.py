@@ -0,0 +1,147 @@
+# self-play metrics: per-phase timers, engine search stats and throughput,
+# reported as json lines or as a prometheus textfile
+import cProfile
+import json
+import os
+import pstats
+import time
+
+# phases of a move in the order they are reported
+PHASES = ["book", "cache", "engine_wait", "engine", "pick", "board", "tree", "output"]
+
+# per-game stopwatch, lap(phase) books the time since the previous lap
+# every game gets its own clock so interleaved asyncio games don't mix laps
+class Clock:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.last = time.perf_counter()
+
+    def lap(self, phase) -> None:
+        now = time.perf_counter()
+        self.metrics.phases[phase] = self.metrics.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+class Metrics:
+    def __init__(self, file_name=None, file_format="jsonl", interval=30, label="main"):
+        self.file_name = file_name
+        self.file_format = file_format
+        self.interval = interval
+        self.label = label
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.games = 0
+        self.positions = 0
+        self.searches = 0
+        self.engine_nodes = 0
+        self.engine_time = 0.0
+        self.engine_depth = 0
+        self.phases = {}
+
+    def clock(self) -> Clock:
+        return Clock(self)
+
+    # nodes, time and depth of the first pv of an analyse() result
+    def add_search(self, info) -> None:
+        self.searches += 1
+        self.engine_nodes += info.get("nodes", 0)
+        self.engine_time += info.get("time", 0.0)
+        self.engine_depth += info.get("depth", 0)
+
+    # count a finished game and report if the interval has passed
+    def add_game(self, plies) -> None:
+        self.games += 1
+        self.positions += plies
+        if self.file_name and time.perf_counter() - self.last_report >= self.interval:
+            self.write()
+
+    def snapshot(self) -> dict:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        phases = {phase: round(self.phases.get(phase, 0.0), 6) for phase in PHASES}
+        for phase in self.phases:
+            phases.setdefault(phase, round(self.phases[phase], 6))
+        return {
+            "time": round(time.time(), 3),
+            "label": self.label,
+            "elapsed": round(elapsed, 3),
+            "games": self.games,
+            "positions": self.positions,
+            "games_per_second": round(self.games / elapsed, 4),
+            "positions_per_second": round(self.positions / elapsed, 2),
+            "searches": self.searches,
+            "engine_nodes": self.engine_nodes,
+            "engine_time": round(self.engine_time, 6),
+            "engine_nps": round(self.engine_nodes / self.engine_time) if self.engine_time else 0,
+            "engine_depth": round(self.engine_depth / self.searches, 2) if self.searches else 0,
+            # search wall time the engine itself didn't report, uci round trips and parsing
+            "uci_overhead": round(max(phases.get("engine", 0.0) - self.engine_time, 0.0), 6),
+            "phases": phases,
+        }
+
+    # append a json line, or rewrite the prometheus textfile
+    def write(self) -> None:
+        self.last_report = time.perf_counter()
+        snapshot = self.snapshot()
+        if self.file_format == "prom":
+            write_prometheus(self.file_name, snapshot)
+        else:
+            with open(self.file_name, "a") as metrics_file:
+                metrics_file.write(json.dumps(snapshot) + "\n")
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        total = sum(snapshot["phases"].values()) or 1
+        phases = ", ".join(f"{phase} {round(seconds / total * 100, 1)}%" for phase, seconds in snapshot["phases"].items() if seconds)
+        return (f"{snapshot['games_per_second']} games/s, {snapshot['positions_per_second']} positions/s, "
+                f"engine {snapshot['engine_nps']} nps at depth {snapshot['engine_depth']}, "
+                f"uci overhead {round(snapshot['uci_overhead'], 2)}s, time: {phases}")
+
+    def close(self) -> None:
+        if self.file_name:
+            self.write()
+
+# prometheus textfile collector format, written to a temporary file and
+# renamed so the collector never reads half a file
+def write_prometheus(file_name, snapshot) -> None:
+    label = f'worker="{snapshot["label"]}"'
+    lines = []
+    for key in ["games", "positions", "searches", "engine_nodes"]:
+        lines.append(f"# TYPE selfplay_{key}_total counter")
+        lines.append(f"selfplay_{key}_total{{{label}}} {snapshot[key]}")
+    for key in ["elapsed", "engine_time", "uci_overhead"]:
+        lines.append(f"# TYPE selfplay_{key}_seconds counter")
+        lines.append(f"selfplay_{key}_seconds{{{label}}} {snapshot[key]}")
+    for key in ["games_per_second", "positions_per_second", "engine_nps", "engine_depth"]:
+        lines.append(f"# TYPE selfplay_{key} gauge")
+        lines.append(f"selfplay_{key}{{{label}}} {snapshot[key]}")
+    lines.append("# TYPE selfplay_phase_seconds counter")
+    for phase, seconds in snapshot["phases"].items():
+        lines.append(f'selfplay_phase_seconds{{{label},phase="{phase}"}} {seconds}')
+
+    temporary_name = file_name + ".tmp"
+    with open(temporary_name, "w") as metrics_file:
+        metrics_file.write("\n".join(lines) + "\n")
+    os.replace(temporary_name, file_name)
+
+# metrics for one process, a prometheus textfile per worker since the
+# collector reads whole files, json lines of all workers share a file
+def open_metrics(file_name=None, file_format="jsonl", interval=30, label="main") -> Metrics:
+    if file_name and file_format == "prom" and label != "main":
+        root, extension = os.path.splitext(file_name)
+        file_name = f"{root}-{label}{extension}"
+    return Metrics(file_name, file_format, interval, label)
+
+# run function under cProfile when profile_file is set, dump the stats there
+# and print the heaviest calls
+def run_profiled(profile_file, function, *args, **kwargs):
+    if not profile_file:
+        return function(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profile.disable()
+        profile.dump_stats(profile_file)
+        print(f"profile written to", profile_file)
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# deterministic stand-in uci engine for benchmarks
+# answers every search instantly with canned scores: material from the side
+# to move plus a fixed jitter per (position, move), so the same moves and
+# evals come back on every run and the python side of self-play is what's measured
+# EvalFile picks a mock net: a text file holding its jitter in centipawns (the
+# larger, the weaker it plays), every net also gets its own jitter pattern
+import sys
+import chess
+import chess.polyglot
+import zlib
+
+PIECE_VALUES = [0, 100, 300, 300, 500, 900, 0]
+
+# reported speed, the search itself takes no time
+NPS = 1000000
+
+# jitter of the default net
+NOISE = 61
+
+def send(line) -> None:
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+def material(board) -> int:
+    score = 0
+    for piece_type in range(chess.PAWN, chess.KING):
+        value = PIECE_VALUES[piece_type]
+        score += value * len(board.pieces(piece_type, board.turn))
+        score -= value * len(board.pieces(piece_type, not board.turn))
+    return score
+
+# jitter and salt of a mock net file
+def load_net(file_name) -> tuple:
+    try:
+        with open(file_name) as net_file:
+            noise = max(1, int(net_file.read().split()[0]))
+    except (OSError, ValueError, IndexError):
+        noise = NOISE
+    return noise, zlib.crc32(file_name.encode())
+
+# scored candidate moves of the root, best first
+def search(board, root_moves, noise=NOISE, salt=0) -> list:
+    key = chess.polyglot.zobrist_hash(board) ^ salt
+    base = material(board)
+    scored = []
+    for move in root_moves:
+        captured = board.piece_type_at(move.to_square)
+        score = base + (PIECE_VALUES[captured] if captured else 0) + ((key ^ (move.from_square << 6 | move.to_square) * 0x9E3779B1) % noise) - noise // 2
+        scored.append((score, move))
+    scored.sort(key=lambda entry: -entry[0])
+    return scored
+
+def main() -> None:
+    board = chess.Board()
+    start_fen = None
+    moves = []
+    multipv = 1
+    noise, salt = NOISE, 0
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "uci":
+            send("id name MockUCI")
+            send("id author selfplay bench")
+            send("option name MultiPV type spin default 1 min 1 max 500")
+            send("option name Hash type spin default 16 min 1 max 1024")
+            send("option name Threads type spin default 1 min 1 max 1")
+            send("option name EvalFile type string default nn.nnue")
+            send("uciok")
+        elif command == "isready":
+            send("readyok")
+        elif command == "setoption":
+            if "name" in tokens and "value" in tokens and tokens[tokens.index("name") + 1] == "MultiPV":
+                multipv = max(1, int(tokens[tokens.index("value") + 1]))
+            if "name" in tokens and "value" in tokens and tokens[tokens.index("name") + 1] == "EvalFile":
+                value = " ".join(tokens[tokens.index("value") + 1:])
+                noise, salt = load_net(value) if value != "nn.nnue" else (NOISE, 0)
+        elif command == "ucinewgame":
+            board = chess.Board()
+            start_fen = None
+            moves = []
+        elif command == "position":
+            if tokens[1] == "startpos":
+                fen = None
+                rest = tokens[2:]
+            else:
+                end = tokens.index("moves") if "moves" in tokens else len(tokens)
+                fen = " ".join(tokens[2:end])
+                rest = tokens[end:]
+            new_moves = rest[1:] if rest and rest[0] == "moves" else []
+
+            # self-play sends the whole game every move, only push the new moves
+            if fen != start_fen or new_moves[:len(moves)] != moves:
+                board = chess.Board(fen) if fen else chess.Board()
+                start_fen = fen
+                moves = []
+            for move in new_moves[len(moves):]:
+                board.push_uci(move)
+            moves = new_moves
+        elif command == "go":
+            nodes = int(tokens[tokens.index("nodes") + 1]) if "nodes" in tokens else 1
+            if "searchmoves" in tokens:
+                root_moves = [chess.Move.from_uci(move) for move in tokens[tokens.index("searchmoves") + 1:]]
+            else:
+                root_moves = list(board.legal_moves)
+
+            if not root_moves:
+                send("info depth 0 score mate 0" if board.is_check() else "info depth 0 score cp 0")
+                send("bestmove (none)")
+                continue
+
+            time_ms = max(1, nodes * 1000 // NPS)
+            scored = search(board, root_moves, noise, salt)
+            for rank, (score, move) in enumerate(scored[:multipv]):
+                send(f"info depth 1 seldepth 1 multipv {rank + 1} score cp {score} nodes {nodes} nps {NPS} time {time_ms} pv {move.uci()}")
+            send(f"bestmove {scored[0][1].uci()}")
+        elif command == "quit":
+            break
+
+if __name__ == "__main__":
+    main()
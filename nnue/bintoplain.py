@@ -0,0 +1,31 @@
+import argparse
+import sys
+import compressed
+import sfen
+
+# convert packed sfen .bin records to stockfish trainer text format
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bin", type=str, required=True)
+    parser.add_argument("--output", type=str, help="defaults to stdout")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many positions")
+    args = parser.parse_args()
+
+    input_file = compressed.open_file(args.bin, "rb")
+    output_file = compressed.open_file(args.output, "w") if args.output else sys.stdout
+
+    positions = 0
+    for packed, score, move, ply, result in sfen.read_bin(input_file):
+        board = sfen.unpack_sfen(packed)
+        sfen.write_plain(output_file, board.fen(), sfen.decode_move(move), score, ply, result)
+
+        positions += 1
+        if positions == args.limit:
+            break
+
+    input_file.close()
+    if args.output:
+        output_file.close()
+
+if __name__ == "__main__":
+    main()
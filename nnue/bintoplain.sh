@@ -5,14 +5,6 @@
 # ./bintoplain.sh test.bin test.txt
 # best for debugging bins
 
-NNUE=sf-trainer
-
 # $1 = input
 # $2 = output
-options="setoption name SkipLoadingEval value true
-isready
-learn convert_plain output_file_name $2 $1
-quit
-"
-
-printf "$options" | $NNUE
\ No newline at end of file
+python3 "$(dirname "$0")/bintoplain.py" --bin $1 --output $2
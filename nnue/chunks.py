@@ -0,0 +1,86 @@
+# chunked numpy views of .plain and .bin training files
+import numpy as np
+import compressed
+import sfen
+
+# positions per chunk
+CHUNK = 1000000
+
+# packed sfen record layout
+BIN_DTYPE = np.dtype([("sfen", "V32"), ("score", "<i2"), ("move", "<u2"), ("ply", "<u2"), ("result", "i1"), ("padding", "u1")])
+
+assert BIN_DTYPE.itemsize == sfen.RECORD_SIZE
+
+# raw lines of a .plain chunk with its score/ply/result columns
+class PlainChunk:
+    def __init__(self, lines):
+        self.lines = lines
+        if len(lines) % 6 == 0 and lines[5::6].count("e\n") == len(lines) // 6 and lines[2].startswith("score "):
+            # fen/move/score/ply/result/e records, take the fields by stride
+            self.score_lines = range(2, len(lines), 6)
+            self.fen_lines = range(0, len(lines), 6)
+            ply_lines = lines[3::6]
+            result_lines = lines[4::6]
+        else:
+            self.score_lines = [i for i, line in enumerate(lines) if line.startswith("score ")]
+            self.fen_lines = [i for i, line in enumerate(lines) if line.startswith("fen ")]
+            ply_lines = [line for line in lines if line.startswith("ply ")]
+            result_lines = [line for line in lines if line.startswith("result ")]
+        self.scores = np.array([lines[i][6:] for i in self.score_lines], dtype=np.int64)
+        self.plies = np.array([line[4:] for line in ply_lines], dtype=np.int64)
+        self.results = np.array([line[7:] for line in result_lines], dtype=np.int64)
+        assert len(self.scores) == len(self.plies) == len(self.results), "Incomplete record in chunk."
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def fens(self) -> list:
+        return [self.lines[i][4:-1] for i in self.fen_lines]
+
+    # text of every record, from its fen line up to the next one
+    def records(self) -> list:
+        ends = list(self.fen_lines[1:]) + [len(self.lines)]
+        return ["".join(self.lines[start:end]) for start, end in zip(self.fen_lines, ends)]
+
+    # replace the score lines
+    def set_scores(self, scores) -> None:
+        for i, score in zip(self.score_lines, scores.tolist()):
+            self.lines[i] = f"score {score}\n"
+
+# chunks of a .plain file, each ending on a complete record
+def read_plain_chunks(file_name, chunk=CHUNK):
+    with compressed.open_file(file_name, "r") as plain_file:
+        while True:
+            lines = plain_file.readlines(chunk * 64)
+            if not lines:
+                return
+            while lines[-1] != "e\n":
+                line = plain_file.readline()
+                if not line:
+                    break
+                lines.append(line)
+            yield PlainChunk(lines)
+
+# record arrays of a packed sfen .bin file, memory-mapped
+# compressed files are streamed instead
+def read_bin_chunks(file_name, chunk=CHUNK):
+    if compressed.is_compressed(file_name):
+        with compressed.open_file(file_name, "rb") as bin_file:
+            while True:
+                data = bin_file.read(chunk * BIN_DTYPE.itemsize)
+                if len(data) < BIN_DTYPE.itemsize:
+                    return
+                yield np.frombuffer(data[:len(data) - len(data) % BIN_DTYPE.itemsize], dtype=BIN_DTYPE)
+
+    records = np.memmap(file_name, dtype=BIN_DTYPE, mode="r")
+    for start in range(0, len(records), chunk):
+        yield records[start:start + chunk]
+
+# (score, ply, result) column chunks of a .plain or .bin file
+def read_columns(file_name, chunk=CHUNK):
+    if compressed.strip(file_name).endswith(".bin"):
+        for records in read_bin_chunks(file_name, chunk):
+            yield records["score"], records["ply"], records["result"]
+    else:
+        for plain_chunk in read_plain_chunks(file_name, chunk):
+            yield plain_chunk.scores, plain_chunk.plies, plain_chunk.results
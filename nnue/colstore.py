@@ -0,0 +1,169 @@
+# columnar position store: a <name>.cols directory with one raw file per
+# PackedSfenValue field, each memory-mappable as a numpy array
+import argparse
+import json
+import os
+import os.path
+import shutil
+import numpy as np
+import chess
+import chunks
+import compressed
+import sfen
+
+COLUMNS = [("sfen", "V32"), ("score", "<i2"), ("move", "<u2"), ("ply", "<u2"), ("result", "i1")]
+
+# is the path a column store
+def is_store(file_name) -> bool:
+    return file_name.rstrip("/").endswith(".cols")
+
+# plain, bin or cols by file name
+def file_type_of(file_name) -> str:
+    if is_store(file_name):
+        return "cols"
+    return "bin" if compressed.strip(file_name).endswith(".bin") else "plain"
+
+def column_path(store, column) -> str:
+    return os.path.join(store, column + ".dat")
+
+# appends records to a store, creating it if needed
+# write() takes packed sfen records, so anything that writes .bin can write a store
+class ColumnWriter:
+    def __init__(self, store):
+        self.store = store
+        os.makedirs(store, exist_ok=True)
+        meta_path = os.path.join(store, "meta.json")
+        if not os.path.exists(meta_path):
+            with open(meta_path, "w") as meta_file:
+                json.dump({"format": "sfen-columns", "version": 1, "columns": dict(COLUMNS)}, meta_file)
+        self.files = {column: open(column_path(store, column), "ab") for column, _ in COLUMNS}
+
+    # append whole PackedSfenValue records
+    def write(self, data) -> None:
+        records = np.frombuffer(data, dtype=chunks.BIN_DTYPE)
+        self.write_array(records)
+
+    # append a structured array with the store columns
+    def write_array(self, records) -> None:
+        for column, _ in COLUMNS:
+            self.files[column].write(np.ascontiguousarray(records[column]).tobytes())
+
+    def close(self) -> None:
+        for column_file in self.files.values():
+            column_file.close()
+
+# memory-mapped columns of a store
+class ColumnStore:
+    def __init__(self, store, mode="r"):
+        self.store = store
+        with open(os.path.join(store, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        assert meta["format"] == "sfen-columns", "Not a column store: " + store
+
+        self.columns = {}
+        for column, dtype in meta["columns"].items():
+            size = os.path.getsize(column_path(store, column))
+            if size == 0:
+                self.columns[column] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[column] = np.memmap(column_path(store, column), dtype=dtype, mode=mode)
+
+        lengths = set(len(values) for values in self.columns.values())
+        assert len(lengths) == 1, "Columns of different length in " + store
+
+    def __len__(self) -> int:
+        return len(self.columns["score"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    # structured record arrays, chunk by chunk
+    def read_chunks(self, chunk=chunks.CHUNK):
+        for start in range(0, len(self), chunk):
+            records = np.zeros(min(chunk, len(self) - start), dtype=chunks.BIN_DTYPE)
+            for column, _ in COLUMNS:
+                records[column] = self.columns[column][start:start + chunk]
+            yield records
+
+    # (score, ply, result) slices of the mapped columns, nothing is copied
+    def read_columns(self, chunk=chunks.CHUNK):
+        for start in range(0, len(self), chunk):
+            yield self.columns["score"][start:start + chunk], self.columns["ply"][start:start + chunk], self.columns["result"][start:start + chunk]
+
+# open an output for records of file_type, an existing store is replaced unless appending
+# .plain and .bin outputs are compressed by extension
+def open_output(file_name, file_type, append=False):
+    if file_type == "cols":
+        if not append and os.path.exists(os.path.join(file_name, "meta.json")):
+            shutil.rmtree(file_name)
+        return ColumnWriter(file_name)
+    if file_type == "bin":
+        return compressed.open_file(file_name, "ab" if append else "wb")
+    return compressed.open_file(file_name, "a+" if append else "w")
+
+# append one store to another
+def append_store(source, target) -> None:
+    writer = ColumnWriter(target)
+    for records in ColumnStore(source).read_chunks():
+        writer.write_array(records)
+    writer.close()
+
+# append a part file or store to the output and remove it
+def append_part(part_name, file_name, file_type) -> None:
+    if file_type == "cols":
+        append_store(part_name, file_name)
+        shutil.rmtree(part_name)
+        return
+    with open(file_name, "ab") as output_file, open(part_name, "rb") as part_file:
+        shutil.copyfileobj(part_file, output_file)
+    os.remove(part_name)
+
+# convert between .plain, .bin and .cols
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True, help=".plain, .bin or .cols")
+    parser.add_argument("--output", type=str, required=True, help=".plain, .bin or .cols")
+    args = parser.parse_args()
+
+    input_type = file_type_of(args.input)
+    output_type = file_type_of(args.output)
+    if input_type == "plain" and output_type == "plain":
+        parser.error("nothing to convert, both files are .plain")
+
+    positions = 0
+
+    # source records as structured arrays
+    if input_type == "cols":
+        source = ColumnStore(args.input).read_chunks()
+    elif input_type == "bin":
+        source = chunks.read_bin_chunks(args.input)
+    else:
+        source = None
+
+    output_file = open_output(args.output, output_type)
+
+    if source == None:
+        # text input, pack every position
+        with compressed.open_file(args.input, "r") as input_file:
+            for fen, move, score, ply, result in sfen.read_plain(input_file):
+                board = chess.Board(fen)
+                output_file.write(sfen.format_bin(board, chess.Move.from_uci(move), score, ply, result))
+                positions += 1
+                if positions % 100000 == 0:
+                    print(f"positions converted:", positions)
+    else:
+        for records in source:
+            if output_type == "cols":
+                output_file.write_array(records)
+            elif output_type == "bin":
+                output_file.write(records.tobytes())
+            else:
+                for packed, score, move, ply, result, _ in records.tolist():
+                    sfen.write_plain(output_file, sfen.board_fen(sfen.unpack_sfen(packed)), sfen.decode_move(move), score, ply, result)
+            positions += len(records)
+            print(f"positions converted:", positions)
+
+    output_file.close()
+
+if __name__ == "__main__":
+    main()
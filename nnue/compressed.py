@@ -0,0 +1,61 @@
+# transparent .gz/.zst compression by file extension
+# both formats may be concatenated, so appending per game and merging part
+# files byte by byte still gives one valid stream
+# .zst needs the zstandard package (pip install zstandard)
+import gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = [".gz", ".zst"]
+
+# compression settings for the writers, see configure()
+LEVELS = {".gz": 6, ".zst": 3}
+THREADS = 0
+
+# set the compression level and the zstd worker threads (-1 for all cores)
+def configure(level=None, threads=0) -> None:
+    global THREADS
+    if level != None:
+        for extension in LEVELS:
+            LEVELS[extension] = level
+    THREADS = threads
+
+def compression_of(file_name):
+    for extension in EXTENSIONS:
+        if file_name.endswith(extension):
+            return extension
+    return None
+
+def is_compressed(file_name) -> bool:
+    return compression_of(file_name) != None
+
+# file name without the compression extension, "a.plain.zst" -> "a.plain"
+def strip(file_name) -> str:
+    extension = compression_of(file_name)
+    return file_name[:-len(extension)] if extension else file_name
+
+# add a suffix before the compression extension, ("a.plain.zst", ".part0") -> "a.plain.part0.zst"
+def insert_suffix(file_name, suffix) -> str:
+    extension = compression_of(file_name) or ""
+    return strip(file_name) + suffix + extension
+
+# open() that compresses or decompresses by extension, text and binary modes
+# work like they do for open(), "+" is dropped as compressed files can't be read while written
+def open_file(file_name, mode="r"):
+    extension = compression_of(file_name)
+    if extension == None:
+        return open(file_name, mode)
+
+    mode = mode.replace("+", "")
+    writing = mode[0] in "wax"
+    if extension == ".gz":
+        if "b" not in mode:
+            mode += "t"
+        return gzip.open(file_name, mode, compresslevel=LEVELS[".gz"]) if writing else gzip.open(file_name, mode)
+
+    assert zstandard != None, "Install the zstandard package to use .zst files."
+    if writing:
+        return zstandard.open(file_name, mode, cctx=zstandard.ZstdCompressor(level=LEVELS[".zst"], threads=THREADS))
+    return zstandard.open(file_name, mode)
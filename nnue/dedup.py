@@ -0,0 +1,206 @@
+# cross-game position deduplication keyed on the zobrist hash
+import abc
+import argparse
+import math
+import os
+import sqlite3
+import tempfile
+import chess
+import chess.polyglot
+import compressed
+import sfen
+
+# zobrist key of a position
+def position_key(board) -> int:
+    return chess.polyglot.zobrist_hash(board)
+
+# bloom filter over zobrist keys
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    # set the bits of the key, returns True if they were all set already
+    # double hashing on the two halves of the zobrist key
+    def add(self, key) -> bool:
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        present = True
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            mask = 1 << (bit & 7)
+            if not self.array[bit >> 3] & mask:
+                present = False
+                self.array[bit >> 3] |= mask
+        return present
+
+    # stops at the first clear bit, a miss rarely looks at more than two
+    def contains(self, key) -> bool:
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            if not self.array[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+# counters shared by the dedup stages
+class Dedup(abc.ABC):
+    total = 0
+    duplicates = 0
+
+    # record the key, returns True if it was already seen
+    @abc.abstractmethod
+    def seen(self, key) -> bool:
+        pass
+
+    # record the position, returns True if it was already seen
+    def seen_position(self, board) -> bool:
+        return self.seen(position_key(board))
+
+    def ratio(self) -> float:
+        return self.duplicates / self.total if self.total else 0.0
+
+    def summary(self) -> str:
+        return f"dedup: {self.duplicates} of {self.total} positions dropped ({round(self.ratio() * 100, 2)}%)"
+
+    def close(self) -> None:
+        pass
+
+# exact set of seen keys, spilled to an on-disk sqlite table once it
+# holds more than max_entries keys
+# a bloom filter over the spilled keys answers most misses, only keys it
+# (maybe) holds are looked up in the table
+class ExactDedup(Dedup):
+    def __init__(self, max_entries=0, spill_dir=None):
+        self.keys = set()
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.spill = None
+        self.spill_file = None
+        self.spilled = 0
+        self.spill_filter = None
+        self.lookups = 0
+        self.total = 0
+        self.duplicates = 0
+
+    def contains(self, key) -> bool:
+        if key in self.keys:
+            return True
+        if self.spill != None and self.spill_filter.contains(key):
+            # sqlite integers are signed 64 bit
+            self.lookups += 1
+            row = self.spill.execute("SELECT 1 FROM seen WHERE key = ?", (key - (1 << 63),)).fetchone()
+            return row != None
+        return False
+
+    # record the key, returns True if it was already seen
+    def seen(self, key) -> bool:
+        self.total += 1
+        if self.contains(key):
+            self.duplicates += 1
+            return True
+        self.keys.add(key)
+        if self.max_entries and len(self.keys) > self.max_entries:
+            self.flush()
+        return False
+
+    # move the in-memory keys to the spill table
+    def flush(self) -> None:
+        if self.spill == None:
+            fd, self.spill_file = tempfile.mkstemp(prefix="dedup-", suffix=".sqlite", dir=self.spill_dir)
+            os.close(fd)
+            self.spill = sqlite3.connect(self.spill_file)
+            self.spill.execute("PRAGMA journal_mode = OFF")
+            self.spill.execute("PRAGMA synchronous = OFF")
+            self.spill.execute("CREATE TABLE seen (key INTEGER PRIMARY KEY)")
+        self.spill.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((key - (1 << 63),) for key in self.keys))
+        self.spill.commit()
+        self.spilled += len(self.keys)
+
+        # the filter is rebuilt twice as large from the table once it's full,
+        # so its false positive rate stays put however far the table grows
+        if self.spill_filter == None or self.spilled > self.spill_filter.capacity:
+            self.spill_filter = BloomFilter(max(2 * self.spilled, 4 * self.max_entries), 0.01)
+            for (key,) in self.spill.execute("SELECT key FROM seen"):
+                self.spill_filter.add(key + (1 << 63))
+        else:
+            for key in self.keys:
+                self.spill_filter.add(key)
+        self.keys.clear()
+
+    def summary(self) -> str:
+        summary = super().summary()
+        if self.spill != None:
+            summary += f", {self.spilled} keys spilled, {self.lookups} spill lookups"
+        return summary
+
+    def close(self) -> None:
+        if self.spill != None:
+            self.spill.close()
+            os.remove(self.spill_file)
+            self.spill = None
+
+# bloom filter over the keys, for 100M+ positions where an exact set
+# does not fit in memory, false positives drop a few unique positions
+class BloomDedup(Dedup):
+    def __init__(self, capacity, error_rate=0.001):
+        self.filter = BloomFilter(capacity, error_rate)
+        self.total = 0
+        self.duplicates = 0
+
+    # record the key, returns True if it was (probably) already seen
+    def seen(self, key) -> bool:
+        self.total += 1
+        present = self.filter.add(key)
+        if present:
+            self.duplicates += 1
+        return present
+
+# build a dedup stage from the cli options, None when disabled
+def open_dedup(mode, capacity=10000000, spill_dir=None):
+    if mode == "exact":
+        return ExactDedup(capacity if spill_dir else 0, spill_dir)
+    if mode == "bloom":
+        return BloomDedup(capacity)
+    return None
+
+# dedup an existing .plain or .bin file, optionally .gz/.zst
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--mode", type=str, default="exact", choices=["exact", "bloom"])
+    parser.add_argument("--capacity", type=int, default=10000000, help="bloom filter size, or in-memory keys before spilling")
+    parser.add_argument("--spill_dir", type=str, help="spill exact keys to disk in this directory")
+    args = parser.parse_args()
+
+    dedup = open_dedup(args.mode, args.capacity, args.spill_dir)
+
+    if compressed.strip(args.input).endswith(".bin"):
+        input_file = compressed.open_file(args.input, "rb")
+        output_file = compressed.open_file(args.output, "wb")
+        for record in sfen.read_bin(input_file):
+            if not dedup.seen_position(sfen.unpack_sfen(record[0])):
+                output_file.write(sfen.RECORD.pack(*record))
+            if dedup.total % 100000 == 0:
+                print(f"positions parsed:", dedup.total)
+    else:
+        input_file = compressed.open_file(args.input, "r")
+        output_file = compressed.open_file(args.output, "w")
+        for fen, move, score, ply, result in sfen.read_plain(input_file):
+            if not dedup.seen_position(chess.Board(fen)):
+                sfen.write_plain(output_file, fen, move, score, ply, result)
+            if dedup.total % 100000 == 0:
+                print(f"positions parsed:", dedup.total)
+
+    input_file.close()
+    output_file.close()
+    dedup.close()
+
+    print(dedup.summary())
+
+if __name__ == "__main__":
+    main()
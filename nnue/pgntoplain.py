@@ -1,9 +1,22 @@
+import chess.engine
 import chess.pgn
 import argparse
 import glob
+import io
+import multiprocessing
+import os
 import re
+import time
 from typing import List
 import pdb
+import sfen
+import dedup as dedup_stage
+import colstore
+import compressed
+
+# progress is printed every PROGRESS_GAMES games (serial) or PROGRESS_SECONDS (--jobs)
+PROGRESS_GAMES = 10000
+PROGRESS_SECONDS = 10
 
 def parse_result(result_str:str, board:chess.Board) -> int:
     if result_str == "1/2-1/2":
@@ -28,52 +41,233 @@ def game_sanity_check(game: chess.pgn.Game) -> bool:
         return False
     return True
     
-def parse_game(game: chess.pgn.Game, writer)->None:
+# replays the mainline forward once and writes the positions last move first
+# positions already seen by the optional dedup stage are dropped
+def parse_game(game: chess.pgn.Game, writer, file_type: str = "plain", dedup=None)->None:
     if not game_sanity_check(game):
         return
 
     result: str = game.headers["Result"]
 
-    node = game.end()
-    while node.move != None:
-        move = node.move
-        comment: str = node.comment
-        writer.write("fen " + node.parent.board().fen() + "\n")
-        writer.write("move " + str(move) + "\n")
-        if node.parent.turn() == chess.WHITE:
-            writer.write("score " + str(int(node.eval().pov(chess.WHITE).score(mate_score=15000)*2.08)) + "\n")
-            writer.write("ply " + str(node.ply())+"\n")        
-            writer.write("result " + str(parse_result(result, node.parent.board())) +"\n")
+    board = game.board()
+    ply = game.ply()
+    records = []
+
+    for node in game.mainline():
+        ply += 1
+        if not (dedup and dedup.seen_position(board)):
+            score = int(node.eval().pov(board.turn).score(mate_score=15000)*2.08)
+            records.append(sfen.format_record(file_type, board, node.move, score, ply, parse_result(result, board)))
+        board.push(node.move)
+
+    for record in reversed(records):
+        writer.write(record)
+
+# score of an [%eval] comment, like chess.pgn.GameNode.eval()
+# turn is the side to move after the move
+def parse_eval(comment: str, turn: chess.Color):
+    match = chess.pgn.EVAL_REGEX.search(comment)
+    if not match:
+        return None
+
+    if match.group("mate"):
+        mate = int(match.group("mate"))
+        score = chess.engine.Mate(mate)
+        if mate == 0:
+            return chess.engine.PovScore(score, turn)
+    else:
+        score = chess.engine.Cp(round(float(match.group("cp")) * 100))
+
+    return chess.engine.PovScore(score if turn else -score, turn)
+
+# streams moves and [%eval] comments into training records without
+# building a game tree, the reader keeps the only board
+class RecordVisitor(chess.pgn.BaseVisitor):
+    def __init__(self, writer, file_type: str = "plain", dedup=None):
+        self.writer = writer
+        self.file_type = file_type
+        self.dedup = dedup
+
+    def begin_game(self):
+        self.game_result = None
+        self.records = []
+        # (position, side to move, move, ply, result, comments) of the last move,
+        # the position is a fen for .plain and a packed sfen and move for .bin
+        self.pending = None
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        if tagname == "Result":
+            self.game_result = tagvalue
+
+    def end_headers(self):
+        if not self.game_result in ["1/2-1/2", "0-1", "1-0"]:
+            print("invalid result", self.game_result)
+            return chess.pgn.SKIP
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    # the reader pushes the move on its board right after this call,
+    # so everything the record needs from the board is taken here
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.flush_pending()
+        if self.dedup and self.dedup.seen_position(board):
+            return
+        if self.file_type in sfen.PACKED_TYPES:
+            position = (sfen.pack_sfen(board), sfen.encode_move(board, move))
+        else:
+            position = sfen.board_fen(board)
+        self.pending = (position, board.turn, move, board.ply() + 1, parse_result(self.game_result, board), [])
+
+    def visit_comment(self, comment: str):
+        if self.pending:
+            self.pending[5].append(comment)
+
+    # the eval comment of a move is only complete once the next move starts
+    def flush_pending(self):
+        if not self.pending:
+            return
+        position, turn, move, ply, result, comments = self.pending
+        self.pending = None
+        povscore = parse_eval(" ".join(comments), not turn)
+        score = int(povscore.pov(turn).score(mate_score=15000)*2.08)
+        if self.file_type in sfen.PACKED_TYPES:
+            self.records.append(sfen.pack_record(position[0], score, position[1], ply, result))
+        else:
+            self.records.append(sfen.format_plain(position, move, score, ply, result))
+
+    def handle_error(self, error: Exception):
+        print("pgn error", error)
+
+    def end_game(self):
+        self.flush_pending()
+        for record in reversed(self.records):
+            self.writer.write(record)
+
+    def result(self):
+        return True
+
+# parse every game of a pgn stream, returns the number of games
+# fast streams the games through RecordVisitor instead of building game trees
+def parse_stream(pgn_loader, writer, file_type: str = "plain", dedup=None, label: str = "", fast: bool = False)->int:
+    game_count = 0
+    while True:
+        if fast:
+            if chess.pgn.read_game(pgn_loader, Visitor=lambda: RecordVisitor(writer, file_type, dedup)) is None:
+                break
         else:
-            writer.write("score " + str(int(node.eval().pov(chess.BLACK).score(mate_score=15000)*2.08)) + "\n")
-            writer.write("ply " + str(node.ply())+"\n")        
-            writer.write("result " + str(parse_result(result, node.parent.board())) +"\n")
-        writer.write("e\n")
-        node = node.parent
+            game = chess.pgn.read_game(pgn_loader)
+            if game is None:
+                break
+            parse_game(game, writer, file_type, dedup)
+        game_count += 1
+        if game_count % PROGRESS_GAMES == 0:
+            print(f"parsed games:", game_count, label)
+    return game_count
+
+# split a pgn file into byte ranges of about shard_size that start at a game ([Event tag)
+# a compressed file can't be cut, it's a single shard
+def find_shards(pgn_file: str, shard_size: int)->List[tuple]:
+    size = os.path.getsize(pgn_file)
+    if compressed.is_compressed(pgn_file):
+        return [(pgn_file, 0, size)]
+    starts = [0]
+    with open(pgn_file, "rb") as pgn_loader:
+        target = shard_size
+        while target < size:
+            # skip the partial line, then look for the next game
+            pgn_loader.seek(target)
+            pgn_loader.readline()
+            offset = pgn_loader.tell()
+            line = pgn_loader.readline()
+            while line and not line.startswith(b"[Event "):
+                offset = pgn_loader.tell()
+                line = pgn_loader.readline()
+            if not line:
+                break
+            starts.append(offset)
+            target = offset + shard_size
+    ends = starts[1:] + [size]
+    return [(pgn_file, start, end) for start, end in zip(starts, ends)]
+
+# convert one byte range of a pgn file into its own part file
+def parse_shard(task)->int:
+    pgn_file, start, end, part_name, file_type, dedup_spec, fast = task
+    dedup = dedup_stage.open_dedup(*dedup_spec)
+    writer = colstore.open_output(part_name, file_type)
+    if compressed.is_compressed(pgn_file):
+        # the whole file is the shard, stream it instead of decompressing it into memory
+        with compressed.open_file(pgn_file, "r") as pgn_loader:
+            game_count = parse_stream(pgn_loader, writer, file_type, dedup, part_name, fast)
+    else:
+        with open(pgn_file, "rb") as pgn_loader:
+            pgn_loader.seek(start)
+            data = pgn_loader.read(end - start)
+        game_count = parse_stream(io.StringIO(data.decode("utf-8", errors="replace")), writer, file_type, dedup, part_name, fast)
+    writer.close()
+    if dedup:
+        dedup.close()
+    return game_count
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pgn", type=str, required=True)
     parser.add_argument("--output", type=str, default="plain.txt")
+    parser.add_argument("--format", type=str, default="plain", choices=["plain", "bin", "cols"])
+    parser.add_argument("--dedup", type=str, choices=["exact", "bloom"], help="drop positions already written")
+    parser.add_argument("--dedup_capacity", type=int, default=10000000)
+    parser.add_argument("--dedup_spill", type=str)
+    parser.add_argument("--jobs", type=int, default=1, help="convert byte-range shards in this many processes")
+    parser.add_argument("--shard_mb", type=int, default=64, help="shard size for --jobs")
+    parser.add_argument("--fast", action="store_true", help="stream games through a visitor instead of building game trees")
+    parser.add_argument("--compress_level", type=int, help="gzip/zstd level of a .gz/.zst output")
+    parser.add_argument("--compress_threads", type=int, default=0, help="zstd compression threads, -1 for all cores")
     args = parser.parse_args()
+    compressed.configure(args.compress_level, args.compress_threads)
 
 
     pgn_files: List[str] = glob.glob(args.pgn)
     pgn_files = sorted(pgn_files, key=lambda x:float(re.findall("-(\d+).pgn",x)[0] if re.findall("-(\d+).pgn",x) else 0.0))
-    f = open(args.output, 'w')
+    dedup_spec = (args.dedup, args.dedup_capacity, args.dedup_spill)
+
+    if args.jobs > 1:
+        # shards are written to part files and concatenated in input order
+        shards = []
+        for pgn_file in pgn_files:
+            shards += find_shards(pgn_file, args.shard_mb * 1024 * 1024)
+        tasks = [(pgn_file, start, end, compressed.insert_suffix(args.output, f".shard{i}"), args.format, dedup_spec, args.fast) for i, (pgn_file, start, end) in enumerate(shards)]
+        print(f"parse {len(pgn_files)} files in {len(tasks)} shards with {args.jobs} jobs")
+        if any(compressed.is_compressed(pgn_file) for pgn_file in pgn_files):
+            print("a compressed pgn can't be split, --jobs only runs whole compressed files side by side")
+        if args.dedup:
+            print("dedup runs per shard, run dedup.py over the output for a global pass")
+
+        colstore.open_output(args.output, args.format).close()
+        game_count = 0
+        last_report = time.time()
+        with multiprocessing.Pool(args.jobs) as pool:
+            for i, shard_games in enumerate(pool.imap(parse_shard, tasks)):
+                colstore.append_part(tasks[i][3], args.output, args.format)
+
+                game_count += shard_games
+                if time.time() - last_report >= PROGRESS_SECONDS or i == len(tasks) - 1:
+                    print(f"parsed shards: {i + 1} out of {len(tasks)}, games: {game_count}")
+                    last_report = time.time()
+        return
+
+    dedup = dedup_stage.open_dedup(*dedup_spec)
+    f = colstore.open_output(args.output, args.format)
     for pgn_file in pgn_files:
         print("parse", pgn_file)
-        pgn_loader = open(pgn_file)
-        game_count = 0
-        while True:
-            
-            game = chess.pgn.read_game(pgn_loader)
-            if game is None:
-                break
-            parse_game(game, f)
-            game_count += 1
-            print(f"parsed games:", game_count)
+        pgn_loader = compressed.open_file(pgn_file, "r")
+        game_count = parse_stream(pgn_loader, f, args.format, dedup, fast=args.fast)
+        pgn_loader.close()
+        print(f"parsed games:", game_count)
     f.close()
+
+    if dedup:
+        print(dedup.summary())
+        dedup.close()
     
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,62 +1,150 @@
 import argparse
+import glob
+import multiprocessing
+import numpy as np
 import pdb
-  
-def main() -> None:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--file", type=str, required=True)
-    parser.add_argument("--ply", type=int, default=0)
+import chunks
+import colstore
 
-    args = parser.parse_args()
+# plies above MAX_PLY share the last row of the per-ply tables
+MAX_PLY = 512
 
-    # for avg_after_ply
-    after_ply = args.ply
-    file = args.file
+# abs(score) histogram per ply, in SCORE_BIN wide bins, the last bin holds the overflow
+SCORE_BIN = 8
+SCORE_BINS = 4096 // SCORE_BIN + 1
 
-    plain_file = open(file, "r")
+# scores at or above this are mate scores, left out of max and percentiles
+MATE_SCORE = 30000
 
-    ply_score = {}
-    last_score = None
-    plies = 0
-    scores = []
+# eval buckets of the eval-vs-result calibration table
+CALIBRATION_BUCKET = 100
+CALIBRATION_LIMIT = 1000
 
-    for line in plain_file:
-        values = line.split()
-        if values[0] == "score":
-            last_score = values[1]
-            if int(values[1]) < 30000:
-                scores.append(int(values[1]))
+# fixed-size aggregate of a dataset, memory does not grow with the file
+class Stats:
+    def __init__(self):
+        self.positions = 0
+        self.ply_count = np.zeros(MAX_PLY + 1, dtype=np.int64)
+        self.ply_sum = np.zeros(MAX_PLY + 1, dtype=np.float64)
+        self.ply_sumsq = np.zeros(MAX_PLY + 1, dtype=np.float64)
+        self.ply_hist = np.zeros((MAX_PLY + 1, SCORE_BINS), dtype=np.int64)
+        # exact histogram of the non-mate scores, offset by MATE_SCORE
+        self.score_hist = np.zeros(2 * MATE_SCORE, dtype=np.int64)
+        self.results = np.zeros(3, dtype=np.int64)
+        buckets = 2 * CALIBRATION_LIMIT // CALIBRATION_BUCKET + 1
+        self.calibration = np.zeros((buckets, 3), dtype=np.int64)
 
-        if values[0] == "ply":
-            assert last_score != None
-            ply = values[1]
+    # aggregate a chunk of (score, ply, result) arrays
+    def add(self, scores, plies, results) -> None:
+        scores = scores.astype(np.int64)
+        plies = np.minimum(plies.astype(np.int64), MAX_PLY)
+        results = results.astype(np.int64)
+        abs_scores = np.abs(scores)
 
-            if ply in ply_score.keys():
-                ply_score[int(ply)].append(abs(int(last_score)))
-            else:
-                ply_score[int(ply)] = [abs(int(last_score))]
-            plies += 1
+        self.positions += len(scores)
+        self.ply_count += np.bincount(plies, minlength=MAX_PLY + 1)
+        self.ply_sum += np.bincount(plies, weights=abs_scores, minlength=MAX_PLY + 1)
+        self.ply_sumsq += np.bincount(plies, weights=abs_scores.astype(np.float64) ** 2, minlength=MAX_PLY + 1)
+        bins = np.minimum(abs_scores // SCORE_BIN, SCORE_BINS - 1)
+        np.add.at(self.ply_hist, (plies, bins), 1)
 
-            if plies % 100000 == 0:
-                print(f"positions parsed:", plies)
+        no_mate = np.abs(scores) < MATE_SCORE
+        self.score_hist += np.bincount(scores[no_mate] + MATE_SCORE, minlength=2 * MATE_SCORE)
+        self.results += np.bincount(results + 1, minlength=3)
 
+        buckets = (np.clip(scores, -CALIBRATION_LIMIT, CALIBRATION_LIMIT) + CALIBRATION_LIMIT + CALIBRATION_BUCKET // 2) // CALIBRATION_BUCKET
+        np.add.at(self.calibration, (buckets, results + 1), 1)
+
+    def merge(self, other) -> None:
+        self.positions += other.positions
+        self.ply_count += other.ply_count
+        self.ply_sum += other.ply_sum
+        self.ply_sumsq += other.ply_sumsq
+        self.ply_hist += other.ply_hist
+        self.score_hist += other.score_hist
+        self.results += other.results
+        self.calibration += other.calibration
+
+    # score percentiles from the exact score histogram
+    def percentiles(self, percents) -> list:
+        cumulative = np.cumsum(self.score_hist)
+        if cumulative[-1] == 0:
+            return [0 for _ in percents]
+        return [int(np.searchsorted(cumulative, cumulative[-1] * percent / 100)) - MATE_SCORE for percent in percents]
+
+    def max_score(self) -> int:
+        nonzero = np.nonzero(self.score_hist)[0]
+        return int(nonzero[-1]) - MATE_SCORE if len(nonzero) else 0
+
+# aggregate one file
+def file_stats(file_name) -> Stats:
+    stats = Stats()
+    columns = colstore.ColumnStore(file_name).read_columns() if colstore.is_store(file_name) else chunks.read_columns(file_name)
+    for scores, plies, results in columns:
+        stats.add(scores, plies, results)
+        print(f"positions parsed:", stats.positions, file_name)
+    return stats
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", type=str, required=True, nargs="+", help=".plain, .bin or .cols files, optionally .gz/.zst (globs are expanded)")
+    parser.add_argument("--ply", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="aggregate this many files in parallel")
+    parser.add_argument("--histogram", action="store_true", help="print the abs(score) histogram per ply")
+
+    args = parser.parse_args()
+
+    # for avg_after_ply
+    after_ply = args.ply
+    files = sorted(set(name for pattern in args.file for name in (glob.glob(pattern) or [pattern])))
+
+    stats = Stats()
+    if args.jobs > 1 and len(files) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(files))) as pool:
+            for file_result in pool.imap(file_stats, files):
+                stats.merge(file_result)
+    else:
+        for file in files:
+            stats.merge(file_stats(file))
 
     sum_evals = 0
     ply_count = 0
 
-    for hsh in sorted(ply_score.items()):
-        avg_eval = round(sum(hsh[1]) / len(hsh[1]),2)
-        ply = hsh[0]
-        print(f"ply: {ply}, avg_eval: {avg_eval} ")
+    for ply in np.nonzero(stats.ply_count)[0]:
+        count = stats.ply_count[ply]
+        avg_eval = round(stats.ply_sum[ply] / count, 2)
+        std_eval = round(float(np.sqrt(max(stats.ply_sumsq[ply] / count - (stats.ply_sum[ply] / count) ** 2, 0))), 2)
+        label = f"{ply}+" if ply == MAX_PLY else f"{ply}"
+        print(f"ply: {label}, positions: {count}, avg_eval: {avg_eval}, std_eval: {std_eval} ")
+
+        if args.histogram:
+            bins = np.nonzero(stats.ply_hist[ply])[0]
+            print("  " + " ".join(f"{b * SCORE_BIN}:{stats.ply_hist[ply][b]}" for b in bins))
 
         if ply > after_ply:
             sum_evals += avg_eval
             ply_count += 1
 
-    print(f"file_name: {file}")
-    print(f"average eval after ply {after_ply}: {round(sum_evals/ply_count,0)}")
-    print(f"max eval after ply {after_ply}:", round(max(scores),2))
+    print(f"file_name: {' '.join(files)}")
+    print(f"positions: {stats.positions}")
+    print(f"average eval after ply {after_ply}: {round(sum_evals/ply_count,0) if ply_count else 0}")
+    print(f"max eval after ply {after_ply}:", stats.max_score())
+
+    percents = [1, 5, 25, 50, 75, 95, 99]
+    print("score percentiles: " + ", ".join(f"p{percent}: {value}" for percent, value in zip(percents, stats.percentiles(percents))))
+
+    total = max(stats.results.sum(), 1)
+    print(f"results: loss {round(stats.results[0] / total * 100, 2)}%, draw {round(stats.results[1] / total * 100, 2)}%, win {round(stats.results[2] / total * 100, 2)}%")
 
-    plain_file.close()
+    # expected score of the side to move per eval bucket
+    print("calibration (eval bucket: positions, loss/draw/win %, expected score):")
+    for bucket, (losses, draws, wins) in enumerate(stats.calibration):
+        count = losses + draws + wins
+        if count == 0:
+            continue
+        center = bucket * CALIBRATION_BUCKET - CALIBRATION_LIMIT
+        expected = round((wins + draws / 2) / count, 3)
+        print(f"  {center:+5d}: {count}, {round(losses / count * 100, 1)}/{round(draws / count * 100, 1)}/{round(wins / count * 100, 1)}, {expected}")
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,9 @@
 #!/bin/bash
 
+# gauntlet of the nets in $1 against sf.master's own net, a net stops as soon
+# as its sprt is decided instead of always playing 200 games
+# the default sprt bounds (elo0 -20, elo1 20) decide a net that's clearly weaker or
+# stronger well within the 200, one close to the baseline plays all of them
 NETS=$1
-STR="./c-chess-cli -each tc=4+0.04 option.Hash=8 option.Threads=1 -engine cmd=./sf.master name=sf.master "
 
-for net in $1/*.nnue;
-do
-    STR+="-engine cmd=./sf.master name=sf.${net} option.EvalFile=${net} "
-done
-
-STR+="-games 200 -concurrency 16 -openings file=../books/noob_3moves.epd order=random -repeat -gauntlet -rounds 1 -resign count=3 score=700 -draw count=8 score=10 -pgn $1/out.pgn 0"
-
-eval $STR
\ No newline at end of file
+python3 ../gauntlet.py --engine ./sf.master --nets "$NETS" --option Hash=8 Threads=1 --tc 4+0.04 --max_games 200 --concurrency 16 --openings ../books/noob_3moves.epd --resign_count 3 --resign_score 700 --draw_count 8 --draw_score 10 --pgn "$NETS/out.pgn"
@@ -0,0 +1,250 @@
+# stockfish nnue trainer record formats
+# .plain: six text lines per position (fen/move/score/ply/result/e)
+# .bin: 40 byte PackedSfenValue records, as written by sf-trainer's convert_bin
+import struct
+import chess
+
+# PackedSfenValue: 32 byte packed position, int16 score, uint16 move,
+# uint16 game ply, int8 game result, 1 byte padding
+RECORD = struct.Struct("<32shHHbx")
+RECORD_SIZE = RECORD.size
+
+assert RECORD_SIZE == 40, "PackedSfenValue must be 40 bytes."
+
+# huffman codes of the board pieces, bits are written lsb first
+# kings are stored as squares, so they have no code
+HUFFMAN_CODES = {
+    chess.PAWN: (0b0001, 4),
+    chess.KNIGHT: (0b0011, 4),
+    chess.BISHOP: (0b0101, 4),
+    chess.ROOK: (0b0111, 4),
+    chess.QUEEN: (0b1001, 4),
+}
+HUFFMAN_PIECES = {code: piece_type for piece_type, (code, _) in HUFFMAN_CODES.items()}
+
+# stockfish walks the board from rank 8 to rank 1, file a to file h
+SQUARE_ORDER = [chess.square(file, rank) for rank in range(7, -1, -1) for file in range(8)]
+
+# stockfish move type flags
+MOVE_PROMOTION = 1 << 14
+MOVE_EN_PASSANT = 2 << 14
+MOVE_CASTLING = 3 << 14
+
+# pack a position into the 256 bit sfen stream
+def pack_sfen(board) -> bytes:
+    stream = 0
+    cursor = 0
+
+    # side to move
+    stream |= (board.turn == chess.BLACK) << cursor
+    cursor += 1
+
+    # king squares
+    stream |= board.king(chess.WHITE) << cursor
+    cursor += 6
+    stream |= board.king(chess.BLACK) << cursor
+    cursor += 6
+
+    # remaining pieces, a 1 bit zero for empty squares
+    for square in SQUARE_ORDER:
+        piece_type = board.piece_type_at(square)
+        if piece_type == chess.KING:
+            continue
+        if piece_type == None:
+            cursor += 1
+            continue
+        code, bits = HUFFMAN_CODES[piece_type]
+        stream |= code << cursor
+        cursor += bits
+        stream |= (not board.color_at(square)) << cursor
+        cursor += 1
+
+    # castling rights
+    for color, rook_square in [(chess.WHITE, chess.H1), (chess.WHITE, chess.A1), (chess.BLACK, chess.H8), (chess.BLACK, chess.A8)]:
+        stream |= bool(board.castling_rights & chess.BB_SQUARES[rook_square]) << cursor
+        cursor += 1
+
+    # en passant, only when the capture is actually possible
+    if board.has_legal_en_passant():
+        stream |= 1 << cursor
+        cursor += 1
+        stream |= board.ep_square << cursor
+        cursor += 6
+    else:
+        cursor += 1
+
+    # rule50 (low 6 bits), fullmove number (8 bits), rule50 (high bit)
+    stream |= (board.halfmove_clock & 63) << cursor
+    cursor += 6
+    stream |= (board.fullmove_number & 255) << cursor
+    cursor += 8
+    stream |= ((board.halfmove_clock >> 6) & 1) << cursor
+    cursor += 1
+
+    assert cursor <= 256, "Packed sfen exceeds 256 bits."
+
+    return stream.to_bytes(32, "little")
+
+# unpack a 256 bit sfen stream into a board
+def unpack_sfen(data) -> chess.Board:
+    stream = int.from_bytes(data, "little")
+    cursor = 0
+
+    def read(bits) -> int:
+        nonlocal cursor
+        value = (stream >> cursor) & ((1 << bits) - 1)
+        cursor += bits
+        return value
+
+    board = chess.Board(None)
+    board.turn = chess.BLACK if read(1) else chess.WHITE
+    board.set_piece_at(read(6), chess.Piece(chess.KING, chess.WHITE))
+    board.set_piece_at(read(6), chess.Piece(chess.KING, chess.BLACK))
+
+    for square in SQUARE_ORDER:
+        if board.piece_type_at(square) == chess.KING:
+            continue
+        if not read(1):
+            continue
+        code = 1 | (read(3) << 1)
+        color = chess.BLACK if read(1) else chess.WHITE
+        board.set_piece_at(square, chess.Piece(HUFFMAN_PIECES[code], color))
+
+    castling_rights = 0
+    for rook_square in [chess.H1, chess.A1, chess.H8, chess.A8]:
+        if read(1):
+            castling_rights |= chess.BB_SQUARES[rook_square]
+    board.castling_rights = castling_rights
+
+    if read(1):
+        board.ep_square = read(6)
+
+    halfmove_clock = read(6)
+    board.fullmove_number = read(8)
+    board.halfmove_clock = halfmove_clock | (read(1) << 6)
+
+    return board
+
+# encode a move as a stockfish 16 bit move
+# castling is encoded as king captures rook
+def encode_move(board, move) -> int:
+    to_square = move.to_square
+    if move.promotion:
+        flag = MOVE_PROMOTION | ((move.promotion - chess.KNIGHT) << 12)
+    elif board.is_en_passant(move):
+        flag = MOVE_EN_PASSANT
+    elif board.is_castling(move):
+        flag = MOVE_CASTLING
+        rook_file = 7 if chess.square_file(move.to_square) > chess.square_file(move.from_square) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+    else:
+        flag = 0
+    return flag | (move.from_square << 6) | to_square
+
+# decode a stockfish 16 bit move
+def decode_move(code) -> chess.Move:
+    from_square = (code >> 6) & 63
+    to_square = code & 63
+    flag = code & (3 << 14)
+    if flag == MOVE_PROMOTION:
+        return chess.Move(from_square, to_square, promotion=((code >> 12) & 3) + chess.KNIGHT)
+    if flag == MOVE_CASTLING:
+        king_file = 6 if chess.square_file(to_square) > chess.square_file(from_square) else 2
+        return chess.Move(from_square, chess.square(king_file, chess.square_rank(from_square)))
+    return chess.Move(from_square, to_square)
+
+# castling field of the fen by clean castling rights
+CASTLING_FIELDS = {}
+for rights in range(16):
+    mask = 0
+    field = ""
+    for bit, (rook_square, symbol) in enumerate([(chess.H1, "K"), (chess.A1, "Q"), (chess.H8, "k"), (chess.A8, "q")]):
+        if rights & (1 << bit):
+            mask |= chess.BB_SQUARES[rook_square]
+            field += symbol
+    CASTLING_FIELDS[mask] = field or "-"
+
+# runs of empty squares, longest first
+EMPTY_RUNS = [("1" * run, str(run)) for run in range(8, 1, -1)]
+
+# fen of a position, same as board.fen() for standard chess but built
+# straight from the piece bitboards instead of 64 piece_at() calls
+def board_fen(board) -> str:
+    squares = ["1"] * 64
+    white = board.occupied_co[chess.WHITE]
+    for pieces, white_symbol, black_symbol in ((board.pawns, "P", "p"), (board.knights, "N", "n"), (board.bishops, "B", "b"), (board.rooks, "R", "r"), (board.queens, "Q", "q"), (board.kings, "K", "k")):
+        while pieces:
+            bit = pieces & -pieces
+            squares[bit.bit_length() - 1] = white_symbol if bit & white else black_symbol
+            pieces ^= bit
+
+    placement = "/".join(["".join(squares[rank * 8:rank * 8 + 8]) for rank in range(7, -1, -1)])
+    for run, count in EMPTY_RUNS:
+        placement = placement.replace(run, count)
+
+    castling = CASTLING_FIELDS.get(board.clean_castling_rights())
+    if castling == None:
+        castling = board.castling_xfen()
+    ep_square = chess.SQUARE_NAMES[board.ep_square] if board.has_legal_en_passant() else "-"
+    return f"{placement} {'w' if board.turn else 'b'} {castling} {ep_square} {board.halfmove_clock} {board.fullmove_number}"
+
+# format a position in stockfish trainer text format
+def format_plain(fen, move, score, ply, result) -> str:
+    return f"fen {fen}\nmove {move}\nscore {int(score)}\nply {ply}\nresult {result}\ne\n"
+
+# PackedSfenValue of an already packed position and move
+def pack_record(packed, score, move_code, ply, result) -> bytes:
+    score = max(-32767, min(int(score), 32767))
+    return RECORD.pack(packed, score, move_code, ply, result)
+
+# format a position as a PackedSfenValue
+def format_bin(board, move, score, ply, result) -> bytes:
+    return pack_record(pack_sfen(board), score, encode_move(board, move), ply, result)
+
+# file types holding PackedSfenValue records (.cols is a column store of them)
+PACKED_TYPES = ["bin", "cols"]
+
+# format a position in either trainer format
+def format_record(file_type, board, move, score, ply, result):
+    if file_type in PACKED_TYPES:
+        return format_bin(board, move, score, ply, result)
+    return format_plain(board_fen(board), move, score, ply, result)
+
+# write a position in stockfish trainer text format
+def write_plain(writer, fen, move, score, ply, result) -> None:
+    writer.write(format_plain(fen, move, score, ply, result))
+
+# write a position as a PackedSfenValue, the writer must be binary
+def write_bin(writer, board, move, score, ply, result) -> None:
+    writer.write(format_bin(board, move, score, ply, result))
+
+# write a position in either trainer format
+def write_record(writer, file_type, board, move, score, ply, result) -> None:
+    writer.write(format_record(file_type, board, move, score, ply, result))
+
+# read raw (packed sfen, score, move, ply, result) records from a binary reader
+def read_bin(reader):
+    while True:
+        data = reader.read(RECORD_SIZE)
+        if len(data) < RECORD_SIZE:
+            return
+        yield RECORD.unpack(data)
+
+# read (fen, move, score, ply, result) records from a stockfish trainer text reader
+def read_plain(reader):
+    fen = move = None
+    score = ply = result = 0
+    for line in reader:
+        key, _, value = line.rstrip("\n").partition(" ")
+        if key == "fen":
+            fen = value
+        elif key == "move":
+            move = value
+        elif key == "score":
+            score = int(value)
+        elif key == "ply":
+            ply = int(value)
+        elif key == "result":
+            result = int(value)
+        elif key == "e":
+            yield fen, move, score, ply, result
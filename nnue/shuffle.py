@@ -0,0 +1,297 @@
+# external-memory shuffle and merge of .plain and .bin training files
+# pass 1 cuts the inputs into byte-range chunks, each is shuffled in memory
+#        and written as a run file (in parallel with --jobs), compressed
+#        inputs can't be cut by offset and are streamed into chunks instead
+# pass 2 interleaves the runs at random: every block of the output draws its
+#        per-run record counts from a multivariate hypergeometric, which is
+#        exactly a uniform shuffle of the whole dataset, in bounded memory
+#        a merge of shuffled runs is a shuffled run itself, so with more runs
+#        than files can be open at once they're merged in groups first
+import argparse
+import glob
+import multiprocessing
+import os
+import os.path
+import tempfile
+try:
+    import resource
+except ImportError:
+    resource = None
+import numpy as np
+import compressed
+import sfen
+
+# output records drawn per merge block
+BLOCK = 1000000
+
+# .plain records joined per write
+WRITE_RECORDS = 65536
+
+# bytes of a .plain run read at once, every open run keeps up to this much
+# read ahead, so a merge of many runs holds fan_in times as much
+READ_SIZE = 1 << 16
+
+# packed records as opaque 40 byte values
+BIN_RECORD = np.dtype(("V", sfen.RECORD_SIZE))
+
+def is_bin(file_name) -> bool:
+    return compressed.strip(file_name).endswith(".bin")
+
+# (file, start, end, None) byte ranges of about chunk_size bytes that hold whole records
+def find_chunks(file_name, chunk_size) -> list:
+    size = os.path.getsize(file_name)
+    if is_bin(file_name):
+        chunk_size = max(sfen.RECORD_SIZE, chunk_size - chunk_size % sfen.RECORD_SIZE)
+        size -= size % sfen.RECORD_SIZE
+        return [(file_name, start, min(start + chunk_size, size), None) for start in range(0, size, chunk_size)]
+
+    # .plain chunks end right before a fen line
+    offsets = [0]
+    with open(file_name, "rb") as reader:
+        while offsets[-1] + chunk_size < size:
+            reader.seek(offsets[-1] + chunk_size)
+            reader.readline()
+            while True:
+                offset = reader.tell()
+                line = reader.readline()
+                if not line or line.startswith(b"fen "):
+                    break
+            if offset >= size:
+                break
+            offsets.append(offset)
+    offsets.append(size)
+    return [(file_name, start, end, None) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+# (file, None, None, data) chunks of about chunk_size decompressed bytes that hold whole records
+def read_compressed_chunks(file_name, chunk_size):
+    binary = is_bin(file_name)
+    rest = b""
+    with compressed.open_file(file_name, "rb") as reader:
+        while True:
+            data = rest + reader.read(chunk_size)
+            if not data:
+                return
+            if binary:
+                end = len(data) - len(data) % sfen.RECORD_SIZE
+                data, rest = data[:end], data[end:]
+                if not data:
+                    return
+            else:
+                # finish the record, .plain records end with an "e" line
+                while not data.endswith(b"\ne\n"):
+                    line = reader.readline()
+                    if not line:
+                        break
+                    data += line
+            yield file_name, None, None, data
+
+# chunks of all inputs, in input order
+def input_chunks(files, chunk_size):
+    for file_name in files:
+        if compressed.is_compressed(file_name):
+            yield from read_compressed_chunks(file_name, chunk_size)
+        else:
+            yield from find_chunks(file_name, chunk_size)
+
+# offsets right after the "e" line that ends every whole .plain record of data
+def plain_ends(data) -> np.ndarray:
+    lines = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(lines == ord("\n"))
+    newlines = newlines[newlines + 2 < len(lines)]
+    return newlines[(lines[newlines + 1] == ord("e")) & (lines[newlines + 2] == ord("\n"))] + 3
+
+# whole .plain records as one bytes buffer and the offsets of every record,
+# not a python string per record, so a chunk takes about its own size in memory
+# an incomplete last record is left out
+class PlainRecords:
+    def __init__(self, data, ends=None):
+        self.data = data
+        self.ends = plain_ends(data) if ends is None else ends
+        self.starts = np.zeros(len(self.ends), dtype=np.int64)
+        self.starts[1:] = self.ends[:-1]
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    # write the records in the order of the indices
+    def write(self, writer, order) -> None:
+        for i in range(0, len(order), WRITE_RECORDS):
+            part = order[i:i + WRITE_RECORDS]
+            writer.write(b"".join(self.data[start:end] for start, end in zip(self.starts[part].tolist(), self.ends[part].tolist())))
+
+def to_records(data, binary):
+    return np.frombuffer(data, dtype=BIN_RECORD) if binary else PlainRecords(data)
+
+# records of several runs as one
+def join_records(parts, binary):
+    if binary:
+        return np.concatenate(parts)
+    offsets = np.cumsum([0] + [len(part.data) for part in parts[:-1]])
+    return PlainRecords(b"".join(part.data for part in parts), np.concatenate([part.ends + offset for part, offset in zip(parts, offsets)]))
+
+# reads whole records off a run file, .plain runs are read READ_SIZE bytes at a time
+# and what's left after the last record handed out is kept for the next read
+class RunReader:
+    def __init__(self, run_name, binary):
+        self.file = open(run_name, "rb")
+        self.binary = binary
+        self.rest = b""
+
+    # up to count records
+    def read(self, count):
+        if self.binary:
+            return np.frombuffer(self.file.read(count * sfen.RECORD_SIZE), dtype=BIN_RECORD)
+        pieces = []
+        ends = []
+        size = 0
+        data = self.rest
+        while True:
+            data_ends = plain_ends(data)[:count]
+            if len(data_ends):
+                cut = int(data_ends[-1])
+                pieces.append(data[:cut])
+                ends.append(data_ends + size)
+                size += cut
+                count -= len(data_ends)
+                data = data[cut:]
+            if count == 0:
+                break
+            piece = self.file.read(READ_SIZE)
+            if not piece:
+                break
+            data += piece
+        self.rest = data
+        return PlainRecords(b"".join(pieces), np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64))
+
+    def close(self) -> None:
+        self.file.close()
+
+# write the records in the order of the indices
+def write_records(writer, records, order, binary) -> None:
+    if binary:
+        writer.write(records[order].tobytes())
+    else:
+        records.write(writer, order)
+
+# shuffle one chunk in memory and write it as a run, returns (run file, records)
+def shuffle_chunk(task) -> tuple:
+    file_name, start, end, data, run_name, seed = task
+    binary = is_bin(file_name)
+    if data == None:
+        with open(file_name, "rb") as reader:
+            reader.seek(start)
+            data = reader.read(end - start)
+
+    records = to_records(data, binary)
+    order = np.random.default_rng(seed).permutation(len(records))
+
+    with open(run_name, "wb") as writer:
+        write_records(writer, records, order, binary)
+    return run_name, len(records)
+
+# interleave the shuffled runs uniformly at random into the output
+def merge_runs(runs, output, binary, seed, block=BLOCK) -> int:
+    rng = np.random.default_rng(seed)
+    remaining = np.array([count for _, count in runs], dtype=np.int64)
+    readers = [RunReader(run_name, binary) for run_name, _ in runs]
+    positions = 0
+
+    with compressed.open_file(output, "wb") as writer:
+        while remaining.sum() > 0:
+            # how many records of this block each run gives, runs are already
+            # shuffled so they give their next ones
+            draw = int(min(block, remaining.sum()))
+            counts = rng.multivariate_hypergeometric(remaining, draw)
+            remaining -= counts
+
+            # then the block is shuffled as a whole
+            records = join_records([readers[run].read(int(counts[run])) for run in np.nonzero(counts)[0]], binary)
+            write_records(writer, records, rng.permutation(draw), binary)
+            positions += draw
+            print(f"positions merged:", positions)
+
+    for reader in readers:
+        reader.close()
+    return positions
+
+# runs merged at once, well below the limit of open files
+def default_fan_in() -> int:
+    if resource == None:
+        return 256
+    limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if limit == resource.RLIM_INFINITY:
+        return 1024
+    return max(2, min(1024, limit // 2))
+
+# merge the runs fan_in at a time until a single merge can take all of them
+def reduce_runs(runs, run_dir, binary, seed, block=BLOCK, fan_in=256) -> list:
+    level = 0
+    while len(runs) > fan_in:
+        merged = []
+        for group in range(0, len(runs), fan_in):
+            group_runs = runs[group:group + fan_in]
+            if len(group_runs) == 1:
+                merged += group_runs
+                continue
+            run_name = os.path.join(run_dir, f"level{level}-{group // fan_in}")
+            count = merge_runs(group_runs, run_name, binary, np.random.SeedSequence(seed, spawn_key=(2, level, group // fan_in)), block)
+            for group_run_name, _ in group_runs:
+                os.remove(group_run_name)
+            merged.append((run_name, count))
+        print(f"merge level {level}:", f"{len(runs)} runs into {len(merged)}")
+        runs = merged
+        level += 1
+    return runs
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True, nargs="+", help=".plain or .bin files, optionally .gz/.zst (globs are expanded), all of one format")
+    parser.add_argument("--output", type=str, required=True, help=".plain or .bin, optionally .gz/.zst")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk_mb", type=int, default=256, help="bytes of input shuffled in memory at once, per job")
+    parser.add_argument("--jobs", type=int, default=1, help="shuffle this many chunks in parallel")
+    parser.add_argument("--block", type=int, default=BLOCK, help="records per merge block")
+    parser.add_argument("--fan_in", type=int, help="runs merged at once, half the open file limit by default")
+    parser.add_argument("--tmp_dir", type=str, help="directory for the run files, next to the output by default")
+    parser.add_argument("--compress_level", type=int, help="gzip/zstd level of a .gz/.zst output")
+    parser.add_argument("--compress_threads", type=int, default=0, help="zstd compression threads, -1 for all cores")
+    args = parser.parse_args()
+    compressed.configure(args.compress_level, args.compress_threads)
+
+    files = sorted(set(name for pattern in args.input for name in (glob.glob(pattern) or [pattern])))
+    binary = is_bin(args.output)
+    assert all(is_bin(file) == binary for file in files), "Inputs and output must all be .plain or all be .bin."
+
+    run_dir = tempfile.mkdtemp(prefix="shuffle-", dir=args.tmp_dir or os.path.dirname(os.path.abspath(args.output)))
+
+    # one seed per chunk, so the result doesn't depend on --jobs
+    tasks = ((file, start, end, data, os.path.join(run_dir, f"run{i}"), np.random.SeedSequence(args.seed, spawn_key=(0, i))) for i, (file, start, end, data) in enumerate(input_chunks(files, args.chunk_mb * 1024 * 1024)))
+    print(f"shuffle {len(files)} files with {args.jobs} jobs")
+
+    # chunks are handed out --jobs at a time, so streamed chunks don't pile up in memory
+    runs = []
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    batch = []
+    for task in tasks:
+        batch.append(task)
+        if len(batch) == args.jobs:
+            runs += pool.map(shuffle_chunk, batch) if pool else [shuffle_chunk(batch[0])]
+            batch = []
+            print(f"chunks shuffled:", len(runs))
+    if batch:
+        runs += pool.map(shuffle_chunk, batch)
+        print(f"chunks shuffled:", len(runs))
+    if pool:
+        pool.close()
+
+    runs = reduce_runs(runs, run_dir, binary, args.seed, args.block, max(2, args.fan_in or default_fan_in()))
+    positions = merge_runs(runs, args.output, binary, np.random.SeedSequence(args.seed, spawn_key=(1,)), args.block)
+
+    for run_name, _ in runs:
+        os.remove(run_name)
+    os.rmdir(run_dir)
+
+    print(f"shuffled positions: {positions}, output: {args.output}")
+
+if __name__ == "__main__":
+    main()
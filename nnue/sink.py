@@ -0,0 +1,158 @@
+# buffered output sink: one long-lived handle per output instead of an
+# open/close per game, records are collected and written in one call per flush
+# with rotation on, the output is cut into size-bounded shards that are
+# written under a hidden name and renamed into place once complete
+import os
+import os.path
+import shutil
+import time
+import colstore
+import compressed
+
+# flush once this many bytes are buffered, whatever the interval
+BUFFER_BYTES = 1 << 20
+
+# add a label before the format extension, ("a.plain.zst", ".worker1") -> "a.worker1.plain.zst"
+def insert_label(file_name, label) -> str:
+    root, extension = os.path.splitext(compressed.strip(file_name))
+    return root + label + extension + (compressed.compression_of(file_name) or "")
+
+# name of shard index of an output, "a.plain.zst" -> "a.0003.plain.zst"
+def shard_name(file_name, index) -> str:
+    return insert_label(file_name, f".{index:04d}")
+
+# hidden name a shard is written under, the extensions are kept so the
+# format and the compression are still known
+def hidden_name(file_name) -> str:
+    directory, name = os.path.split(file_name)
+    return os.path.join(directory, "." + name)
+
+class OutputSink:
+    # file_type is pgn, plain, bin or cols, records are str for pgn/plain and bytes otherwise
+    # flush_seconds bounds how long finished games stay in memory
+    # rotate_bytes (0 for off) is the uncompressed size of a shard
+    def __init__(self, file_name, file_type, flush_seconds=10, rotate_bytes=0):
+        self.file_name = file_name
+        self.file_type = file_type
+        self.flush_seconds = flush_seconds
+        self.rotate_bytes = rotate_bytes
+        self.buffer = []
+        self.buffered = 0
+        # records and bytes of the buffer up to the end of the last whole game,
+        # a flush never writes a game that is only partly buffered
+        self.complete = 0
+        self.complete_bytes = 0
+        self.written = 0
+        self.shard = 0
+        self.shards = []
+        self.handle = None
+        self.last_flush = time.monotonic()
+        self.flushes = 0
+        # with checkpoints the handle is closed after every flush, so a compressed
+        # output ends on a whole gzip member/zstd frame and can be cut at its size
+        self.checkpointed = False
+
+    # the file or shard being written
+    def current_name(self) -> str:
+        return hidden_name(shard_name(self.file_name, self.shard)) if self.rotate_bytes else self.file_name
+
+    def open_handle(self) -> None:
+        name = self.current_name()
+        if self.file_type == "pgn":
+            self.handle = compressed.open_file(name, "a")
+        else:
+            self.handle = colstore.open_output(name, self.file_type, append=True)
+
+    def write(self, record) -> None:
+        self.buffer.append(record)
+        self.buffered += len(record)
+
+    # a game is complete, flush if the buffer is full, the shard is or the interval has passed
+    # shards are only cut between games, so they end up a game over rotate_bytes at most
+    def end_game(self) -> None:
+        self.complete = len(self.buffer)
+        self.complete_bytes = self.buffered
+        full = self.buffered >= BUFFER_BYTES or (self.rotate_bytes and self.written + self.buffered >= self.rotate_bytes)
+        if full or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        self.last_flush = time.monotonic()
+        if not self.complete:
+            return
+        if self.handle == None:
+            self.open_handle()
+
+        records = self.buffer[:self.complete]
+        data = "".join(records) if self.file_type in ["pgn", "plain"] else b"".join(records)
+        self.handle.write(data)
+        self.written += self.complete_bytes
+        self.buffer = self.buffer[self.complete:]
+        self.buffered -= self.complete_bytes
+        self.complete = 0
+        self.complete_bytes = 0
+        self.flushes += 1
+
+        if self.rotate_bytes and self.written >= self.rotate_bytes:
+            self.rotate()
+        elif self.checkpointed:
+            self.handle.close()
+            self.handle = None
+        elif self.file_type != "cols":
+            self.handle.flush()
+
+    # close the current shard and move it into place
+    def rotate(self) -> None:
+        if self.handle != None:
+            self.handle.close()
+            self.handle = None
+        name = shard_name(self.file_name, self.shard)
+        os.replace(hidden_name(name), name)
+        self.shards.append(name)
+        self.shard += 1
+        self.written = 0
+
+    # sizes of the files being written, a cut back to them drops everything after
+    def sizes(self) -> dict:
+        name = self.current_name()
+        names = [colstore.column_path(name, column) for column, _ in colstore.COLUMNS] if self.file_type == "cols" else [name]
+        return {name: os.path.getsize(name) if os.path.exists(name) else 0 for name in names}
+
+    # where the output stands on disk, for a checkpoint taken right after a flush
+    def state(self) -> dict:
+        return {"shard": self.shard, "shards": self.shards, "written": self.written, "sizes": self.sizes()}
+
+    # cut the output back to a checkpointed state, whatever was written after it is dropped
+    def restore(self, state) -> None:
+        self.shard = state["shard"]
+        self.shards = state["shards"]
+        self.written = state["written"]
+
+        if self.rotate_bytes:
+            # a shard moved into place after the checkpoint goes back to its hidden name,
+            # shards started after it are removed
+            name = shard_name(self.file_name, self.shard)
+            if os.path.exists(name) and not os.path.exists(hidden_name(name)):
+                os.replace(name, hidden_name(name))
+            index = self.shard + 1
+            while os.path.exists(shard_name(self.file_name, index)) or os.path.exists(hidden_name(shard_name(self.file_name, index))):
+                for name in [shard_name(self.file_name, index), hidden_name(shard_name(self.file_name, index))]:
+                    if os.path.isdir(name):
+                        shutil.rmtree(name)
+                    elif os.path.exists(name):
+                        os.remove(name)
+                index += 1
+
+        for name, size in state["sizes"].items():
+            if os.path.exists(name):
+                assert os.path.getsize(name) >= size, f"{name} is shorter than its checkpoint."
+                os.truncate(name, size)
+
+    def close(self) -> None:
+        self.flush()
+        if self.handle != None:
+            self.handle.close()
+            self.handle = None
+        # the last shard goes into place however short it is
+        if self.rotate_bytes and os.path.exists(self.current_name()):
+            self.rotate()
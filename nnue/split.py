@@ -0,0 +1,168 @@
+# leak-free train/validation split
+# whole games go to one side, picked by a hash of the game's key position:
+# for training records the first position written for the game (records
+# are written last move first, so its lowest ply record), for pgn games the
+# position at --key_ply. games sharing that position share a side too,
+# so the validation set never sees an opening line the net was trained on
+import argparse
+import io
+import numpy as np
+import chess
+import chess.pgn
+import chess.polyglot
+import chunks
+import colstore
+import compressed
+import sfen
+
+MASK64 = (1 << 64) - 1
+
+# splitmix64 finalizer, spreads the seed over the key
+def mix(key, seed) -> int:
+    key = (key + seed * 0x9E3779B97F4A7C15) & MASK64
+    key = ((key ^ (key >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    key = ((key ^ (key >> 27)) * 0x94D049BB133111EB) & MASK64
+    return key ^ (key >> 31)
+
+# does the game with this zobrist key go to validation
+def is_validation(key, fraction, seed) -> bool:
+    return mix(key, seed) % 1000000 < fraction * 1000000
+
+# zobrist key of a .plain record or a packed record
+def plain_key(record) -> int:
+    return chess.polyglot.zobrist_hash(chess.Board(record[4:record.index("\n")]))
+
+def packed_key(record) -> int:
+    return chess.polyglot.zobrist_hash(sfen.unpack_sfen(record["sfen"].tobytes()))
+
+# split training records, one chunk at a time
+# the last game of a chunk may go on in the next one, so it's carried over
+def split_records(source, train_file, val_file, fraction, seed, packed) -> tuple:
+    key_of = packed_key if packed else plain_key
+    carry_records = None
+    carry_plies = None
+    counts = [0, 0]
+
+    def write(records, plies, final) -> tuple:
+        # a game starts wherever the ply goes up
+        starts = np.nonzero(np.concatenate(([True], plies[1:] > plies[:-1])))[0]
+        ends = np.append(starts[1:], len(plies))
+        if not final:
+            starts, ends = starts[:-1], ends[:-1]
+
+        validation = np.array([is_validation(key_of(records[end - 1]), fraction, seed) for end in ends], dtype=bool)
+        mask = np.repeat(validation, ends - starts)
+        done = ends[-1] if len(ends) else 0
+        for output, selected in [(train_file, records[:done][~mask]), (val_file, records[:done][mask])]:
+            output.write(selected.tobytes() if packed else "".join(selected))
+        counts[0] += int((~mask).sum())
+        counts[1] += int(mask.sum())
+        return records[done:], plies[done:]
+
+    for chunk in source:
+        if packed:
+            records = np.array(chunk)
+            plies = records["ply"].astype(np.int64)
+        else:
+            records = np.array(chunk.records(), dtype=object)
+            plies = chunk.plies
+        if carry_records is not None:
+            records = np.concatenate((carry_records, records))
+            plies = np.concatenate((carry_plies, plies))
+        if len(plies):
+            carry_records, carry_plies = write(records, plies, False)
+        print(f"positions split: train {counts[0]}, validation {counts[1]}")
+
+    if carry_records is not None and len(carry_plies):
+        write(carry_records, carry_plies, True)
+    return counts[0], counts[1]
+
+# zobrist key of a pgn game at key_ply, or of its last position if it's shorter,
+# the rest of the moves are left unparsed
+class KeyVisitor(chess.pgn.BaseVisitor):
+    def __init__(self, key_ply):
+        self.key_ply = key_ply
+        self.key = None
+        self.board = None
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board, san):
+        if self.key != None:
+            return chess.pgn.SKIP
+
+    def visit_board(self, board) -> None:
+        self.board = board
+        if self.key == None and board.ply() >= self.key_ply:
+            self.key = chess.polyglot.zobrist_hash(board)
+
+    def result(self):
+        if self.key == None and self.board != None:
+            return chess.polyglot.zobrist_hash(self.board)
+        return self.key
+
+# raw text of the games of a pgn file, a game starts at an [Event tag after movetext
+def read_pgn_games(reader):
+    lines = []
+    in_movetext = False
+    for line in reader:
+        if line.startswith("[Event ") and in_movetext:
+            yield "".join(lines)
+            lines = []
+            in_movetext = False
+        elif line.strip() and not line.startswith("["):
+            in_movetext = True
+        lines.append(line)
+    if lines and "".join(lines).strip():
+        yield "".join(lines)
+
+# split pgn games, copied as they are
+def split_pgn(pgn_file, train_file, val_file, fraction, seed, key_ply) -> tuple:
+    counts = [0, 0]
+    with compressed.open_file(pgn_file, "r") as reader:
+        for text in read_pgn_games(reader):
+            key = chess.pgn.read_game(io.StringIO(text), Visitor=lambda: KeyVisitor(key_ply))
+            side = 1 if key != None and is_validation(key, fraction, seed) else 0
+            (val_file if side else train_file).write(text if text.endswith("\n\n") else text.rstrip("\n") + "\n\n")
+            counts[side] += 1
+            if sum(counts) % 10000 == 0:
+                print(f"games split: train {counts[0]}, validation {counts[1]}")
+    return counts[0], counts[1]
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True, help=".plain, .bin, .cols or .pgn, optionally .gz/.zst")
+    parser.add_argument("--train", type=str, required=True, help="training output, same format as the input")
+    parser.add_argument("--val", type=str, required=True, help="validation output, same format as the input")
+    parser.add_argument("--fraction", type=float, default=0.01, help="share of games for validation")
+    parser.add_argument("--seed", type=int, default=0, help="changes which games go to validation")
+    parser.add_argument("--key_ply", type=int, default=15, help="pgn games are keyed on the position at this ply, past the book")
+    args = parser.parse_args()
+
+    if compressed.strip(args.input).endswith(".pgn"):
+        with compressed.open_file(args.train, "w") as train_file, compressed.open_file(args.val, "w") as val_file:
+            train, val = split_pgn(args.input, train_file, val_file, args.fraction, args.seed, args.key_ply)
+        print(f"games: train {train}, validation {val}")
+        return
+
+    file_type = colstore.file_type_of(args.input)
+    assert colstore.file_type_of(args.train) == file_type and colstore.file_type_of(args.val) == file_type, "Outputs must have the input's format."
+
+    if file_type == "cols":
+        source = colstore.ColumnStore(args.input).read_chunks()
+    elif file_type == "bin":
+        source = chunks.read_bin_chunks(args.input)
+    else:
+        source = chunks.read_plain_chunks(args.input)
+
+    train_file = colstore.open_output(args.train, file_type)
+    val_file = colstore.open_output(args.val, file_type)
+    train, val = split_records(source, train_file, val_file, args.fraction, args.seed, file_type != "plain")
+    train_file.close()
+    val_file.close()
+
+    print(f"positions: train {train}, validation {val}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# streaming data pipeline: self-play -> rescoring/dedup -> trainer shards
+# the stages run as processes linked by bounded queues of whole-game record
+# batches, so a slow stage blocks the ones before it instead of piling up data
+#   generate   self-play workers, games go out as packed .bin records
+#   transform  optional global rescoring (nnue/scoreupdate.py models) and dedup
+#   write      rotating .bin shards for the trainer's targetdir, each shard
+#              appears under its final name only once complete, or a named pipe
+# no .plain file and no convert.sh pass in between
+import argparse
+import collections
+import multiprocessing
+import os
+import os.path
+import random
+import stat
+import sys
+import time
+import numpy as np
+import bookindex
+import adjudication as adjudication_stage
+import selfplay
+# nnue trainer formats
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nnue"))
+import chunks
+import dedup as dedup_stage
+import scoreupdate
+import sfen
+import sink
+
+# throughput of a stage, time spent blocked on a queue shows where the backpressure is
+class StageStats:
+    def __init__(self, name, interval=30):
+        self.name = name
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.positions = 0
+        self.blocked = 0.0
+
+    # put or get on a queue, timed
+    def put(self, queue, item) -> None:
+        start = time.perf_counter()
+        queue.put(item)
+        self.blocked += time.perf_counter() - start
+
+    def get(self, queue):
+        start = time.perf_counter()
+        item = queue.get()
+        self.blocked += time.perf_counter() - start
+        return item
+
+    def add(self, positions) -> None:
+        self.positions += positions
+        if time.perf_counter() - self.last_report >= self.interval:
+            self.last_report = time.perf_counter()
+            print(self.summary())
+
+    def summary(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (f"{self.name}: {self.positions} positions, {round(self.positions / elapsed, 1)} positions/s, "
+                f"blocked {round(self.blocked, 1)}s ({round(self.blocked / elapsed * 100, 1)}%)")
+
+# output sink of a self-play worker that sends record batches down a queue
+# instead of writing a file, batches only ever hold whole games
+class QueueSink:
+    def __init__(self, queue, batch_positions, stats):
+        self.queue = queue
+        self.batch_positions = batch_positions
+        self.stats = stats
+        self.buffer = []
+
+    def write(self, record) -> None:
+        self.buffer.append(record)
+
+    def end_game(self) -> None:
+        if len(self.buffer) >= self.batch_positions:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.stats.put(self.queue, b"".join(self.buffer))
+            self.stats.add(len(self.buffer))
+            self.buffer = []
+
+    def close(self) -> None:
+        self.flush()
+
+# a self-play worker's share of the games, its batches go to queue
+GenerateTask = collections.namedtuple("GenerateTask", ["games", "engine", "engines", "concurrency", "nodes", "depth", "multipv", "mode", "book", "min_ply", "first_round", "adjudication", "queue", "batch_positions", "label", "interval", "engine_spec"])
+
+# self-play worker, sends None once its games are done
+def generate(task) -> None:
+    # forked workers inherit the parent's rng state, so reseed from os.urandom
+    random.seed()
+
+    book_reader = bookindex.BookIndex(task.book) if task.book else None
+    stats = StageStats(task.label, task.interval)
+    output = QueueSink(task.queue, task.batch_positions, stats)
+    settings = dict(file_type="bin", nodes=task.nodes, depth=task.depth, multipv=task.multipv, mode=task.mode, file_name=None, book_reader=book_reader, min_ply=task.min_ply, first_round=task.first_round, adjudication=task.adjudication, sink_spec=(0, 0), output=output, engine_spec=task.engine_spec)
+    try:
+        if task.concurrency > 1:
+            selfplay.play_concurrent(task.games, task.engine, task.engines, task.concurrency, **settings)
+        else:
+            selfplay.play(task.games, task.engine, **settings)
+    finally:
+        task.queue.put(None)
+        print(stats.summary())
+
+# rescore, then drop positions seen before, over the batches of all producers
+# rescoring goes first so a game's length still counts the dropped positions
+def transform(inputs, outputs, producers, model, scale, dedup_spec, interval) -> None:
+    rescore = scoreupdate.MODELS[model] if model else None
+    dedup = dedup_stage.open_dedup(*dedup_spec)
+    stats = StageStats("transform", interval)
+
+    finished = 0
+    while finished < producers:
+        batch = stats.get(inputs)
+        if batch == None:
+            finished += 1
+            continue
+
+        records = np.frombuffer(batch, dtype=chunks.BIN_DTYPE).copy()
+        if rescore:
+            plies = records["ply"].astype(np.int64)
+            game_plies, _ = scoreupdate.game_plies_of(plies, (0, 0))
+            new_scores = rescore(records["score"].astype(np.float64), plies, game_plies, records["result"].astype(np.int64), scale).astype(np.int64)
+            records["score"] = np.clip(new_scores, -32767, 32767)
+        if dedup:
+            keep = np.array([not dedup.seen_position(sfen.unpack_sfen(packed.tobytes())) for packed in records["sfen"]], dtype=bool)
+            records = records[keep]
+
+        stats.put(outputs, records.tobytes())
+        stats.add(len(records))
+
+    outputs.put(None)
+    print(stats.summary())
+    if dedup:
+        print(dedup.summary())
+        dedup.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, required=True)
+    parser.add_argument("--engine", type=str, default="lc0")
+    parser.add_argument("--nodes", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=0)
+    parser.add_argument("--multipv", type=int, default=1)
+    parser.add_argument("--mode", type=str, default="random", choices=["softmax", "random", "random-multipv"])
+    parser.add_argument("--book", type=str)
+    parser.add_argument("--min_ply", type=int, default=15)
+    parser.add_argument("--workers", type=int, default=1, help="self-play processes")
+    parser.add_argument("--concurrency", type=int, default=1, help="games in flight per self-play process")
+    parser.add_argument("--engines", type=int, default=1, help="uci engines per self-play process with --concurrency")
+    parser.add_argument("--option", type=str, nargs="*", default=[], help="uci options of every engine, NAME=VALUE")
+    parser.add_argument("--info", type=str, default="lean", choices=sorted(selfplay.INFO_PROFILES))
+    parser.add_argument("--shared_engine", action="store_true", help="one engine plays both colors in a self-play process without --concurrency")
+    parser.add_argument("--resign_count", type=int, default=0)
+    parser.add_argument("--resign_score", type=int, default=700)
+    parser.add_argument("--draw_count", type=int, default=0)
+    parser.add_argument("--draw_score", type=int, default=10)
+    parser.add_argument("--max_ply", type=int, default=0)
+    parser.add_argument("--model", type=str, choices=sorted(scoreupdate.MODELS), help="rescore with a nnue/scoreupdate.py model")
+    parser.add_argument("--scale", type=int, default=100)
+    parser.add_argument("--dedup", type=str, choices=["exact", "bloom"], help="drop positions already seen by any worker")
+    parser.add_argument("--dedup_capacity", type=int, default=10000000)
+    parser.add_argument("--dedup_spill", type=str)
+    parser.add_argument("--output_dir", type=str, default="train", help="shard directory, the trainer's targetdir")
+    parser.add_argument("--prefix", type=str, default="positions", help="shards are named prefix.0000.bin ...")
+    parser.add_argument("--compress", type=str, choices=["gz", "zst"])
+    parser.add_argument("--shard_mb", type=int, default=256, help="uncompressed size of a shard")
+    parser.add_argument("--fifo", type=str, help="stream into this named pipe instead of shards, for a trainer reading one .bin")
+    parser.add_argument("--batch_positions", type=int, default=10000, help="positions a worker sends at once")
+    parser.add_argument("--queue_size", type=int, default=16, help="batches a queue holds before the stage before it blocks")
+    parser.add_argument("--report_interval", type=int, default=30, help="seconds between throughput reports")
+    args = parser.parse_args()
+
+    workers = max(1, min(args.workers, args.games))
+    multipv = args.multipv if (args.multipv > 1 and (args.mode == "random-multipv" or args.mode == "softmax")) else 10
+    adjudication = adjudication_stage.Adjudication(args.resign_count, args.resign_score, args.draw_count, args.draw_score, 0, args.max_ply, args.min_ply)
+    dedup_spec = (args.dedup, args.dedup_capacity, args.dedup_spill)
+    engine_spec = (dict(option.split("=", 1) for option in args.option), args.info, args.shared_engine)
+
+    if args.fifo:
+        if not os.path.exists(args.fifo):
+            os.mkfifo(args.fifo)
+        assert stat.S_ISFIFO(os.stat(args.fifo).st_mode), f"{args.fifo} is not a named pipe."
+        output = sink.OutputSink(args.fifo, "bin", 0)
+        print(f"OUTPUT:", args.fifo, "(named pipe, waits for the reader)")
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        file_name = os.path.join(args.output_dir, args.prefix + ".bin" + ("." + args.compress if args.compress else ""))
+        output = sink.OutputSink(file_name, "bin", 0, args.shard_mb * 1024 * 1024)
+        print(f"OUTPUT:", sink.shard_name(file_name, 0), "...")
+
+    # generate -> records -> transform -> batches -> write
+    records = multiprocessing.Queue(args.queue_size)
+    batches = multiprocessing.Queue(args.queue_size)
+
+    stages = [multiprocessing.Process(target=transform, args=(records, batches, workers, args.model, args.scale, dedup_spec, args.report_interval))]
+    first_round = 1
+    for worker in range(workers):
+        worker_games = args.games // workers + (1 if worker < args.games % workers else 0)
+        task = GenerateTask(games=worker_games, engine=args.engine, engines=args.engines, concurrency=args.concurrency, nodes=args.nodes, depth=args.depth, multipv=multipv, mode=args.mode, book=args.book, min_ply=args.min_ply, first_round=first_round, adjudication=adjudication, queue=records, batch_positions=args.batch_positions, label=f"generate{worker}", interval=args.report_interval, engine_spec=engine_spec)
+        stages.append(multiprocessing.Process(target=generate, args=(task,)))
+        first_round += worker_games
+    for stage in stages:
+        stage.start()
+
+    # the writer runs here, the shard in progress is flushed when interrupted
+    stats = StageStats("write", args.report_interval)
+    try:
+        while True:
+            batch = stats.get(batches)
+            if batch == None:
+                break
+            output.write(batch)
+            output.end_game()
+            stats.add(len(batch) // sfen.RECORD_SIZE)
+    finally:
+        output.close()
+
+    for stage in stages:
+        stage.join()
+
+    print(stats.summary())
+    if not args.fifo:
+        print(f"shards:", len(output.shards), f"in {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,35 @@ import chess
 import chess.pgn
 import chess.engine
 # libraries for move picker
-import chess.polyglot
+import bookindex
 import random
 import math
 # libaries to complete 7 tag roster
 import socket
 import datetime
+# libraries for multi-process and concurrent self-play
+import asyncio
+import collections
+import multiprocessing
 # utilities
 import os
 import os.path
 from os import path
+import sys
 import pdb
+import metrics as metrics_stage
+import adjudication as adjudication_stage
+import analysiscache
+import gamerecord
+import checkpoint
+# nnue trainer formats
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nnue"))
+import sfen
+import dedup as dedup_stage
+import colstore
+import compressed
+import sink
+import distributed
 
 # threshholds
 WIN_THRESHOLD = 100
@@ -24,6 +42,14 @@ WIN_THRESHOLD = 100
 # highest observed from sf gensfen is 3875
 MAX_EVAL = 3875
 
+# info the searches ask for, "lean" is what the move pickers (score, pv), the
+# analysis cache and the metrics (depth, nodes, time) read, "full" parses every
+# info line, refutations and current lines included
+INFO_PROFILES = {
+    "lean": chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV,
+    "full": chess.engine.INFO_ALL,
+}
+
 # parse result of game
 def parse_result(result_str, board) -> int:
     assert board.is_valid(), "Invalid board."
@@ -79,49 +105,61 @@ def gensfen_eval(score, game_progress):
 
     return scaled_eval
 
-# parse to stockfish nnue format
-def parse_game(game, writer, min_ply) -> None:
+# parse to stockfish nnue format, .plain text or packed .bin
+# replays the mainline forward once (node.board() replays from the root on
+# every call), then writes the positions last move first like the trainer expects
+# positions already seen by the optional dedup stage are dropped
+def parse_game(game, writer, min_ply, file_type="plain", dedup=None) -> None:
     if not game_sanity_check(game):
         return
 
     result: str = game.headers["Result"]
 
-    node = game.end()
-    end_ply = node.ply()
-    while node.move != None:
-        # stockfish nnue is sensitive to low evals, thus skip it unless it exceeds min_ply
-        if node.ply() < min_ply:
-            node = node.parent
-            continue
+    end_ply = game.end().ply()
+    board = game.board()
+    ply = game.ply()
+    records = []
 
-        game_progress = node.ply() / end_ply
+    for node in game.mainline():
+        ply += 1
 
-        assert game_progress >= 0 and game_progress <= 1
+        # stockfish nnue is sensitive to low evals, thus skip it unless it exceeds min_ply
+        if ply >= min_ply and not (dedup and dedup.seen_position(board)):
+            game_progress = ply / end_ply
 
-        # stockfish trainer format
-        move = node.move
-        comment: str = node.comment
-        writer.write("fen " + node.parent.board().fen() + "\n")
-        writer.write("move " + str(move) + "\n")
+            assert game_progress >= 0 and game_progress <= 1
 
-        if node.parent.turn() == chess.WHITE:
-            score = node.eval().pov(chess.WHITE).score(mate_score=1500)
+            score = node.eval().pov(board.turn).score(mate_score=1500)
 
             scaled_score = gensfen_eval(score, game_progress)
 
-            writer.write("score " + str(int(scaled_score)) + "\n")
-            writer.write("ply " + str(node.ply())+"\n")        
-            writer.write("result " + str(parse_result(result, node.parent.board())) +"\n")
-        else:
-            score = node.eval().pov(chess.BLACK).score(mate_score=1500)
+            # stockfish trainer format
+            records.append(sfen.format_record(file_type, board, node.move, scaled_score, ply, parse_result(result, board)))
+
+        board.push(node.move)
+
+    for record in reversed(records):
+        writer.write(record)
+
+# parse a self-play game record the same way, without a game tree in between
+def parse_record(game_record, writer, min_ply, file_type="plain", dedup=None) -> None:
+    end_ply = game_record.ply()
+    board = chess.Board()
+    records = []
 
+    for ply in range(1, end_ply + 1):
+        move = game_record.move(ply - 1)
+
+        if ply >= min_ply and not (dedup and dedup.seen_position(board)):
+            game_progress = ply / end_ply
+            score = game_record.score(ply - 1).pov(board.turn).score(mate_score=1500)
             scaled_score = gensfen_eval(score, game_progress)
+            records.append(sfen.format_record(file_type, board, move, scaled_score, ply, parse_result(game_record.result, board)))
+
+        board.push(move)
 
-            writer.write("score " + str(int(scaled_score)) + "\n")
-            writer.write("ply " + str(node.ply())+"\n")        
-            writer.write("result " + str(parse_result(result, node.parent.board())) +"\n")
-        writer.write("e\n")
-        node = node.parent
+    for record in reversed(records):
+        writer.write(record)
 
 # pick random move
 def pick_randomly(results) -> tuple:
@@ -189,8 +227,8 @@ def pick_with_softmax(results, color) -> tuple:
 def pick_bestmove(results) -> tuple:
     return results[0]["pv"][0], results[0]["score"]
 
-# initiate self-play games
-def play(games, engine, file_type, nodes, depth, multipv, mode, file_name, book_reader, min_ply) -> None:
+# build the search limit from the user options
+def make_limit(nodes, depth) -> chess.engine.Limit:
     # intialize options
     if nodes == 0:
         nodes = None
@@ -201,168 +239,626 @@ def play(games, engine, file_type, nodes, depth, multipv, mode, file_name, book_
     if nodes == None and depth == None:
         nodes = 1
 
+    return chess.engine.Limit(nodes=nodes, depth=depth)
+
+# start a uci engine with the options of an engine spec
+def open_engine(engine, options) -> chess.engine.SimpleEngine:
+    simple_engine = chess.engine.SimpleEngine.popen_uci(engine)
+    # an unknown option or a bad value, the engine is closed so the error isn't a hang
+    try:
+        if options:
+            simple_engine.configure(options)
+    except chess.engine.EngineError:
+        simple_engine.quit()
+        raise
+    return simple_engine
+
+# the (white, black) engines, a shared engine plays both colors
+# white's engine is closed again if black's fails to start
+def open_engines(engine, options, shared=False) -> tuple:
+    engine_w = open_engine(engine, options)
+    if shared:
+        return engine_w, engine_w
+    try:
+        return engine_w, open_engine(engine, options)
+    except BaseException:
+        engine_w.quit()
+        raise
+
+# init game tree with the 7 tag roster
+def new_game(engine, round_number) -> chess.pgn.Game:
+    game = chess.pgn.Game()
+    game.headers["White"] = engine
+    game.headers["Black"] = engine
+    game.headers["Round"] = round_number
+    game.headers["Date"] = datetime.date.today().strftime("%Y.%m.%d")
+    game.headers["Site"] = socket.gethostname()
+    game.headers["Event"] = f"Game Generation"
+    return game
+
+# restrict the engine's root moves with a book move or a random move
+# returns the root moves and the multipv to search with
+def pick_root_moves(board, book, mode, multipv, min_ply) -> tuple:
+    # holds list of random moves or book moves for python-chess
+    root_moves = None
+
+    # past the opening every mode plays the best move, the other lines go unread
+    if board.fullmove_number > min_ply/2:
+        multipv = 1
+
+    # probe book, a no-op once the game has left it
+    if book:
+        book_move = book.probe(board)
+        if book_move != None:
+            root_moves = []
+            root_moves.append(book_move)
+            multipv = 1
+            assert root_moves, "Book move not read."
+
+    # if off-book and the mode is random, choose a random move
+    if root_moves and mode == "random" and board.fullmove_number <= min_ply/2:
+        random_move = random.choices(list(board.legal_moves))
+        root_moves = []
+        root_moves.append(random_move[0])
+        multipv = 1
+        assert root_moves, "Random move not found."
+
+    return root_moves, multipv
+
+# pick move from variations given user options
+def pick_move(results, board, mode, min_ply) -> tuple:
+    assert results[0]["score"].relative.score() != None or results[0]["score"].is_mate(), "Score or mate can't be found for engine."
+
+    if board.fullmove_number > min_ply/2:
+        return pick_bestmove(results)
+    elif mode == "softmax":
+        return pick_with_softmax(results, board.turn)
+    else:
+        return pick_randomly(results)
+
+# result of a finished game from the final board and the last score
+def game_result(board, povscore) -> str:
+    # results for checkmate
+    if board.is_checkmate():
+        if board.turn == chess.BLACK:
+            return "1-0"
+        else:
+            return "0-1"
+
+    # results for non-checkmate, the score of the last search from white's point of view
+    score = povscore.white().score(mate_score=32000)
+
+    assert score != None, "Invalid score."
+
+    if (score <= WIN_THRESHOLD and score >= -WIN_THRESHOLD) or board.is_stalemate() or board.is_insufficient_material() or board.is_seventyfive_moves() or board.is_fivefold_repetition():
+        return "1/2-1/2"
+    elif (score < -WIN_THRESHOLD):
+        return "0-1"
+    else:
+        return "1-0"
+
+# write the result in the game record, from the adjudication verdict when there is one
+# returns the adjudication reason, None if the game was played out
+def finish_game(record, board, povscore, verdict):
+    if verdict == None:
+        record.result = game_result(board, povscore)
+        return None
+
+    # a max ply verdict has no result of its own, it's scored like a finished game
+    reason, result = verdict
+    record.result = result or game_result(board, povscore)
+    record.adjudicated = True
+    return reason
+
+# write a game record to the output sink, the game tree is only built for pgn
+def write_game(record, file_type, output, min_ply, dedup=None) -> None:
+    if file_type == "pgn":
+        game = record.to_game(new_game(record.engine, record.round_number))
+        output.write(str(game) + "\n\n")
+
+    # .plain, .bin or .cols training records
+    else:
+        parse_record(record, output, min_ply, file_type, dedup)
+
+    output.end_game()
+
+# initiate self-play games
+# returns the (white_wins, black_wins, draws) counters
+# a journaled run checkpoints its output and picks up from an earlier checkpoint
+# engine_spec is (uci options, info profile, one engine for both colors)
+# session is the caller's open (white, black) engines, they and the book stay open
+def play(games, engine, file_type, nodes, depth, multipv, mode, file_name, book_reader, min_ply, first_round=1, dedup=None, metrics=None, adjudication=None, cache=None, sink_spec=(10, 0), output=None, journal=False, engine_spec=({}, "lean", False), session=None) -> tuple:
+    limit = make_limit(nodes, depth)
+    if metrics == None:
+        metrics = metrics_stage.Metrics()
+    if adjudication == None:
+        adjudication = adjudication_stage.Adjudication()
+
     # to log results
     white_wins = 0
     black_wins = 0
     draws = 0
+    adjudicated = {reason: 0 for reason in adjudication_stage.REASONS}
+
+    # initialize engines, a shared engine plays both colors
+    options, info, shared = engine_spec
+    engine_w, engine_b = session or open_engines(engine, options, shared)
+
+    # buffered games are flushed on the way out, also when interrupted
+    # output is an open sink to write to instead of file_name, like the pipeline's queue
+    if output == None:
+        output = sink.OutputSink(file_name, file_type, *sink_spec)
+    if journal:
+        journal = checkpoint.Journal(file_name, output, first_round)
+        white_wins, black_wins, draws, adjudicated = journal.resume()
+    try:
+        # the rounds of a resumed run that are finished come first
+        for i in range(white_wins + black_wins + draws + 1, games+1):
+
+            # log status
+            if i % 10 == 0 or i == 1 or i == games:
+                print(f"Playing: game {first_round + i - 1} ({i} out of {games})")
+        
+            # moves and scores go to a compact record, not a game tree
+            record = gamerecord.GameRecord(engine, first_round + i - 1)
+
+            # initialize board and book state
+            board = chess.Board()
+            book = book_reader.new_game() if book_reader else None
+            game_adjudication = adjudication.new_game()
+            verdict = None
+            clock = metrics.clock()
+
+            while not board.is_game_over():
+                clock.lap("board")
+                root_moves, move_multipv = pick_root_moves(board, book, mode, multipv, min_ply)
+                clock.lap("book")
+
+                # engine to define UCI move and score for given book, multipv, and mode
+                # positions already analysed with the same settings skip the engine
+                results = cache.get(board, limit, move_multipv, root_moves) if cache else None
+                clock.lap("cache")
+                if results == None:
+                    side_engine = engine_w if board.turn == chess.WHITE else engine_b
+                    # the game record is python-chess's game key, an engine gets a ucinewgame with every new game
+                    results = side_engine.analyse(board, limit, info=INFO_PROFILES[info], multipv=move_multipv, root_moves=root_moves, game=record)
+                    clock.lap("engine")
+                    metrics.add_search(results[0])
+                    if cache:
+                        cache.put(board, limit, move_multipv, root_moves, results)
+                        clock.lap("cache")
+
+                # pick move from variations given user options
+                move, povscore = pick_move(results, board, mode, min_ply)
+                clock.lap("pick")
+
+                # apply the move to the board data structure
+                board.push(move)
+
+                assert board.is_valid(), "Invalid move."
+                clock.lap("board")
+
+                # record the move and the score
+                record.add(move, povscore)
+                clock.lap("tree")
+
+                # stop early once the game is decided
+                verdict = game_adjudication.update(board, povscore)
+                if verdict:
+                    break
+
+            clock.lap("board")
+
+            # write the result in the game record
+            reason = finish_game(record, board, povscore, verdict)
+            if reason:
+                adjudicated[reason] += 1
+            result = record.result
+            if result == "1-0":
+                white_wins += 1
+            elif result == "0-1":
+                black_wins += 1
+            else:
+                draws += 1
 
-    # initialize engines
-    engine_w = chess.engine.SimpleEngine.popen_uci(engine)
-    engine_b = chess.engine.SimpleEngine.popen_uci(engine)
+            assert (draws + white_wins + black_wins) == i, "Results don't add up to total game count."
 
-    for i in range(1, games+1):
+            write_game(record, file_type, output, min_ply, dedup)
+            if journal:
+                journal.add(record.round_number, white_wins, black_wins, draws, adjudicated)
+            clock.lap("output")
+            metrics.add_game(board.ply())
+    finally:
+        output.close()
 
-        # log status
-        if i % 10 == 0 or i == 1 or i == games:
-            print(f"Playing: game {i} out of {games}")
-        
-        # init game tree
-        game = chess.pgn.Game()
-        game.headers["White"] = engine
-        game.headers["Black"] = engine
-        game.headers["Round"] = i
-        game.headers["Date"] = datetime.date.today().strftime("%Y.%m.%d")
-        game.headers["Site"] = socket.gethostname()
-        game.headers["Event"] = f"Game Generation"
-        
-        # init game node
-        node = None
+    # the games of the last flush
+    if journal:
+        journal.sync()
 
-        # initialize board
-        board = chess.Board()
-
-        while not board.is_game_over():
-            
-            # holds all variations
-            results = None
-
-            # holds list of random moves or book moves for python-chess
-            root_moves = None
-
-            # actual book move state
-            book_move = None
-
-            # probe book
-            if book_reader:
-                entries = list(book_reader.find_all(board))
-                if list(entries) != []:
-                    book_move = random.choices(list(entries))[0].move
-                    root_moves = []
-                    root_moves.append(book_move)
-                    multipv = 1
-                    assert root_moves, "Book move not read."
-            
-            # if off-book and the mode is random, choose a random move
-            if root_moves and mode == "random" and board.fullmove_number <= min_ply/2:
-                random_move = random.choices(list(board.legal_moves))
-                root_moves = []
-                root_moves.append(random_move[0])
-                multipv = 1
-                assert root_moves, "Random move not found."
-
-            # engine to define UCI move and score for given book, multipv, and mode
-            if board.turn == chess.WHITE:
-                results = engine_w.analyse(board, chess.engine.Limit(nodes=nodes, depth=depth), info=chess.engine.Info.ALL, multipv=multipv, root_moves=root_moves)
-
-                assert results[0]["score"].relative.score() != None or results[0]["score"].is_mate(), "Score or mate can't be found for engine on white side."
-            else:
-                results = engine_b.analyse(board, chess.engine.Limit(nodes=nodes, depth=depth), info=chess.engine.Info.ALL, multipv=multipv,root_moves=root_moves)
+    if session:
+        return white_wins, black_wins, draws, adjudicated
 
-                assert results[0]["score"].relative.score() != None or results[0]["score"].is_mate(), "Score or mate can't be found for engine on black side."
+    # exit book
+    if book_reader:
+        book_reader.close()
 
-            # pick move from variations given user options
-            if board.fullmove_number > min_ply/2:
-                move, povscore = pick_bestmove(results)
-            elif mode == "softmax":
-                move, povscore = pick_with_softmax(results, board.turn)
-            else:
-                move, povscore = pick_randomly(results)
+    # exit engines
+    engine_w.quit()
+    if not shared:
+        engine_b.quit()
+
+    return white_wins, black_wins, draws, adjudicated
+
+# play a single game on an engine checked out of the pool for the whole game
+# the game record is passed as python-chess's game key, so the engine gets a
+# single ucinewgame per game and keeps its hash between the moves of the game
+# returns the game record and its adjudication reason
+async def play_game_async(pool, engine, round_number, limit, multipv, mode, book_reader, min_ply, metrics, adjudication, cache, info="lean") -> tuple:
+    record = gamerecord.GameRecord(engine, round_number)
+    board = chess.Board()
+    book = book_reader.new_game() if book_reader else None
+    game_adjudication = adjudication.new_game()
+    verdict = None
+    clock = metrics.clock()
+
+    protocol = await pool.get()
+    clock.lap("engine_wait")
+    try:
+        while not board.is_game_over():
+            clock.lap("board")
+            root_moves, move_multipv = pick_root_moves(board, book, mode, multipv, min_ply)
+            clock.lap("book")
+
+            results = cache.get(board, limit, move_multipv, root_moves) if cache else None
+            clock.lap("cache")
+            if results == None:
+                results = await protocol.analyse(board, limit, info=INFO_PROFILES[info], multipv=move_multipv, root_moves=root_moves, game=record)
+                clock.lap("engine")
+                metrics.add_search(results[0])
+                if cache:
+                    cache.put(board, limit, move_multipv, root_moves, results)
+                    clock.lap("cache")
+
+            move, povscore = pick_move(results, board, mode, min_ply)
+            clock.lap("pick")
 
-            # apply the move to the board data structure
             board.push(move)
 
             assert board.is_valid(), "Invalid move."
-
-            # write the move in the game tree (for pgn / plain)
-            if(node == None):
-                node = game.add_main_variation(move)
-            else:
-                node = node.add_main_variation(move)
-
-            # write the score in the game tree
-            node.set_eval(povscore)
-
-            # write the result in the game tree if game is over
-            if board.is_game_over():
-                # results for checkmate
-                if board.is_checkmate():
-                    if node.parent.turn() == chess.WHITE:
-                        game.headers['Result'] = "1-0"
-                        white_wins += 1
-                    else:
-                        game.headers['Result'] = "0-1"
-                        black_wins += 1
-
-                # results for non-checkmate
-                else:
-                    score = povscore.relative.score(mate_score=32000)
-
-                    assert score != None, "Invalid score."
-                    
-                    if (score <= WIN_THRESHOLD and score >= -WIN_THRESHOLD) or board.is_stalemate() or board.is_insufficient_material() or board.is_seventyfive_moves() or board.is_fivefold_repetition():
-                        game.headers['Result'] = "1/2-1/2"
-                        draws += 1
-                    elif (score < -WIN_THRESHOLD):
-                        game.headers['Result'] = "0-1"
-                        black_wins += 1
-                    elif (score > WIN_THRESHOLD):
-                        game.headers['Result'] = "1-0"
-                        white_wins += 1
-
-                assert (draws + white_wins + black_wins) == i, "Results don't add up to total game count."
-
-        # write game tree to file
-        if file_type == "plain":
-            output_file = open(file_name, 'a+')
-            parse_game(game, output_file, min_ply)
-            output_file.close()
-
-            assert path.exists(file_name), "Couldn't create .plain file."
-
-        elif file_type == "pgn":
-            print(game, file=open(file_name, "a+"), end="\n\n")
-
-            assert path.exists(file_name), "Couldn't create .pgn file."
-
+            clock.lap("board")
+
+            record.add(move, povscore)
+            clock.lap("tree")
+
+            verdict = game_adjudication.update(board, povscore)
+            if verdict:
+                break
+    finally:
+        pool.put_nowait(protocol)
+
+    clock.lap("board")
+    reason = finish_game(record, board, povscore, verdict)
+    return record, reason
+
+# start a pool of uci engines for the asyncio driver
+# returns the queue engines are checked out of and the engines to close
+# if an engine fails to start or to take the options, the ones started are closed
+async def open_engine_pool(engine, engines, options=None) -> tuple:
+    pool = asyncio.Queue()
+    protocols = []
+    try:
+        for _ in range(engines):
+            _, protocol = await chess.engine.popen_uci(engine)
+            protocols.append(protocol)
+            if options:
+                await protocol.configure(options)
+            pool.put_nowait(protocol)
+    except BaseException:
+        await close_engine_pool(protocols)
+        raise
+    return pool, protocols
+
+# quit the engines of a pool, an engine killed by the same SIGINT never answers quit
+async def close_engine_pool(protocols) -> None:
+    for protocol in protocols:
+        try:
+            await asyncio.wait_for(protocol.quit(), 5)
+        except asyncio.TimeoutError:
+            pass
+
+# keep `concurrency` games in flight over a pool of `engines` uci engines
+# a game holds its engine until it's over, games beyond `engines` wait for one
+# the pool is shared by both colors already, the shared flag of engine_spec changes nothing here
+# session is the caller's open (pool, protocols), they and the book stay open
+async def play_async(games, engine, engines, concurrency, file_type, nodes, depth, multipv, mode, file_name, book_reader, min_ply, first_round=1, dedup=None, metrics=None, adjudication=None, cache=None, sink_spec=(10, 0), output=None, journal=False, engine_spec=({}, "lean", False), session=None) -> tuple:
+    limit = make_limit(nodes, depth)
+    if metrics == None:
+        metrics = metrics_stage.Metrics()
+    if adjudication == None:
+        adjudication = adjudication_stage.Adjudication()
+
+    # initialize engine pool
+    options, info, _ = engine_spec
+    pool, protocols = session or await open_engine_pool(engine, engines, options)
+
+    counters = {"1-0": 0, "0-1": 0, "1/2-1/2": 0}
+    adjudicated = {reason: 0 for reason in adjudication_stage.REASONS}
+    if output == None:
+        output = sink.OutputSink(file_name, file_type, *sink_spec)
+    if journal:
+        journal = checkpoint.Journal(file_name, output, first_round)
+        counters["1-0"], counters["0-1"], counters["1/2-1/2"], adjudicated = journal.resume()
+
+    # rounds are handed out in order, games finish (and get written) in any order
+    # a resumed run skips the rounds its checkpoint has
+    rounds = iter([round_number for round_number in range(first_round, first_round + games) if not (journal and journal.is_finished(round_number))])
+
+    async def runner() -> None:
+        for round_number in rounds:
+            record, reason = await play_game_async(pool, engine, round_number, limit, multipv, mode, book_reader, min_ply, metrics, adjudication, cache, info)
+            counters[record.result] += 1
+            if reason:
+                adjudicated[reason] += 1
+
+            finished = sum(counters.values())
+            if finished % 10 == 0 or finished == 1 or finished == games:
+                print(f"Finished: game {round_number} ({finished} out of {games})")
+
+            clock = metrics.clock()
+            write_game(record, file_type, output, min_ply, dedup)
+            if journal:
+                journal.add(round_number, counters["1-0"], counters["0-1"], counters["1/2-1/2"], adjudicated)
+            clock.lap("output")
+            metrics.add_game(record.ply())
+
+    try:
+        await asyncio.gather(*(runner() for _ in range(min(concurrency, games))))
+    finally:
+        output.close()
+        if not session:
+            await close_engine_pool(protocols)
+
+    if journal:
+        journal.sync()
 
     # exit book
-    book_reader.close()
+    if book_reader and not session:
+        book_reader.close()
 
-    # exit engines
-    engine_w.quit()
-    engine_b.quit()
+    return counters["1-0"], counters["0-1"], counters["1/2-1/2"], adjudicated
+
+# run the asyncio driver to completion
+def play_concurrent(games, engine, engines, concurrency, file_type, nodes, depth, multipv, mode, file_name, book_reader, min_ply, first_round=1, dedup=None, metrics=None, adjudication=None, cache=None, sink_spec=(10, 0), output=None, journal=False, engine_spec=({}, "lean", False)) -> tuple:
+    return asyncio.run(play_async(games, engine, engines, concurrency, file_type=file_type, nodes=nodes, depth=depth, multipv=multipv, mode=mode, file_name=file_name, book_reader=book_reader, min_ply=min_ply, first_round=first_round, dedup=dedup, metrics=metrics, adjudication=adjudication, cache=cache, sink_spec=sink_spec, output=output, journal=journal, engine_spec=engine_spec))
 
-    # log results
+# log results
+def print_results(games, white_wins, black_wins, draws, adjudicated=None) -> None:
     print(f"white win rate: {round(white_wins / games * 100,2)}%")
     print(f"black win rate: {round(black_wins / games * 100,2)}%")
     print(f"draw rate: {round(draws / games * 100,2)}%")
+    if adjudicated and sum(adjudicated.values()):
+        print(f"adjudicated: {sum(adjudicated.values())} games ({round(sum(adjudicated.values()) / games * 100,2)}%), " + ", ".join(f"{reason} {count}" for reason, count in adjudicated.items()))
+
+# a worker's share of a --workers run, file_name is its part of the output
+WorkerTask = collections.namedtuple("WorkerTask", ["games", "engine", "engines", "concurrency", "file_type", "nodes", "depth", "multipv", "mode", "file_name", "book", "min_ply", "first_round", "dedup_spec", "metrics_spec", "profile_file", "adjudication", "cache_spec", "sink_spec", "journal", "engine_spec"])
+
+# play a share of the games in its own process, with its own engines and book reader
+def play_worker(task) -> tuple:
+    # forked workers inherit the parent's rng state, so reseed from os.urandom
+    # a resumed worker gets the state of its checkpoint back
+    random.seed()
+
+    book_reader = bookindex.BookIndex(task.book) if task.book else None
+
+    # positions are only deduplicated within a worker, run nnue/dedup.py over the merged file for a global pass
+    dedup = dedup_stage.open_dedup(*task.dedup_spec)
+    metrics = metrics_stage.open_metrics(*task.metrics_spec)
+    cache = analysiscache.open_cache(*task.cache_spec)
+
+    settings = dict(file_type=task.file_type, nodes=task.nodes, depth=task.depth, multipv=task.multipv, mode=task.mode, file_name=task.file_name, book_reader=book_reader, min_ply=task.min_ply, first_round=task.first_round, dedup=dedup, metrics=metrics, adjudication=task.adjudication, cache=cache, sink_spec=task.sink_spec, journal=task.journal, engine_spec=task.engine_spec)
+    try:
+        if task.concurrency > 1:
+            counters = metrics_stage.run_profiled(task.profile_file, play_concurrent, task.games, task.engine, task.engines, task.concurrency, **settings)
+        else:
+            counters = metrics_stage.run_profiled(task.profile_file, play, task.games, task.engine, **settings)
+    except KeyboardInterrupt:
+        # the parent got the SIGINT too, the part is flushed and it merges what's there
+        counters = None
+
+    if dedup:
+        print(f"worker {task.file_name}", dedup.summary())
+        dedup.close()
+
+    if metrics.file_name:
+        print(f"worker {task.file_name}", metrics.summary())
+        metrics.close()
+
+    if cache:
+        print(f"worker {task.file_name}", cache.summary())
+        cache.close()
+
+    return counters
+
+# concatenate the worker parts in round order
+# rotated parts are shards of their own and are left as they are
+def merge_parts(tasks, file_name, file_type) -> None:
+    for task in tasks:
+        part_name = task.file_name
+        if path.exists(part_name):
+            colstore.append_part(part_name, file_name, file_type)
+
+# the worker checkpoints of a journaled run, once it's finished
+def remove_part_checkpoints(tasks) -> None:
+    for task in tasks:
+        checkpoint.remove_checkpoint(task.file_name)
+
+# plays the batches a distributed coordinator hands out
+# the batch message holds the run's settings, the engine, its options and the book are the worker's own
+# the engines and the book are opened once and kept from batch to batch, the
+# engine pool of --concurrency lives on an event loop of its own for that
+class BatchPlayer:
+    def __init__(self, engine, engines, concurrency, book, engine_spec=({}, "lean", False)):
+        self.engine = engine
+        self.engines = engines
+        self.concurrency = concurrency
+        self.book = book
+        self.book_reader = None
+        self.engine_spec = engine_spec
+        self.loop = None
+        options, _, shared = engine_spec
+        if concurrency > 1:
+            self.loop = asyncio.new_event_loop()
+            self.session = self.loop.run_until_complete(open_engine_pool(engine, engines, options))
+        else:
+            self.session = open_engines(engine, options, shared)
+
+    # play a batch message's games into output, returns the counters
+    def play(self, batch, output) -> tuple:
+        # the seed makes a batch replay the same when it's handed out again
+        random.seed(batch["seed"])
+        book = self.book or batch["book"]
+        if book and self.book_reader == None:
+            self.book_reader = bookindex.BookIndex(book)
+        adjudication = adjudication_stage.Adjudication(**batch["adjudication"])
+        # the coordinator rotates and compresses the output, the batch is only sent back
+        settings = dict(file_type=batch["file_type"], nodes=batch["nodes"], depth=batch["depth"], multipv=batch["multipv"], mode=batch["mode"], file_name=None, book_reader=self.book_reader, min_ply=batch["min_ply"], first_round=batch["first_round"], adjudication=adjudication, sink_spec=(0, 0), output=output, engine_spec=self.engine_spec, session=self.session)
+        if self.concurrency > 1:
+            return self.loop.run_until_complete(play_async(batch["games"], self.engine, self.engines, self.concurrency, **settings))
+        return play(batch["games"], self.engine, **settings)
+
+    # once the coordinator is done
+    def close(self) -> None:
+        if self.loop:
+            self.loop.run_until_complete(close_engine_pool(self.session[1]))
+            self.loop.close()
+        else:
+            engine_w, engine_b = self.session
+            engine_w.quit()
+            if engine_b != engine_w:
+                engine_b.quit()
+        if self.book_reader:
+            self.book_reader.close()
+
+# spread the games over worker processes, then merge their output and counters
+# a journaled run checkpoints every part, a resumed one plays on from the part checkpoints
+def play_parallel(workers, games, engine, engines, concurrency, file_type, nodes, depth, multipv, mode, file_name, book, min_ply, dedup_spec=(None,), metrics_spec=(None, "jsonl", 30), profile_file=None, adjudication=None, cache_spec=(0, None, ""), sink_spec=(10, 0), journal=False, engine_spec=({}, "lean", False)) -> tuple:
+    tasks = []
+    first_round = 1
+    for worker in range(workers):
+        # split the games as evenly as possible, earlier workers take the remainder
+        worker_games = games // workers + (1 if worker < games % workers else 0)
+        if worker_games == 0:
+            continue
+        # rotated worker output is never merged, its shards are named like the output's
+        if sink_spec[1]:
+            part_name = sink.insert_label(file_name, f".worker{worker}")
+        else:
+            part_name = compressed.insert_suffix(file_name, f".part{worker}")
+        # metrics and profiles are labelled per worker
+        worker_metrics_spec = metrics_spec + (f"worker{worker}",)
+        worker_profile_file = f"{profile_file}.worker{worker}" if profile_file else None
+        tasks.append(WorkerTask(games=worker_games, engine=engine, engines=engines, concurrency=concurrency, file_type=file_type, nodes=nodes, depth=depth, multipv=multipv, mode=mode, file_name=part_name, book=book, min_ply=min_ply, first_round=first_round, dedup_spec=dedup_spec, metrics_spec=worker_metrics_spec, profile_file=worker_profile_file, adjudication=adjudication, cache_spec=cache_spec, sink_spec=sink_spec, journal=journal, engine_spec=engine_spec))
+        first_round += worker_games
+
+    pool = multiprocessing.Pool(len(tasks))
+    results = pool.map_async(play_worker, tasks)
+    try:
+        counters = results.get()
+    except KeyboardInterrupt:
+        # the workers got the SIGINT too and flush their parts on the way out,
+        # wait for them and keep what was written
+        # the parts of a journaled run stay, --resume plays on from them
+        results.wait()
+        if not journal:
+            merge_parts(tasks, file_name, file_type)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    merge_parts(tasks, file_name, file_type)
+    if journal:
+        remove_part_checkpoints(tasks)
+
+    white_wins = sum(counter[0] for counter in counters)
+    black_wins = sum(counter[1] for counter in counters)
+    draws = sum(counter[2] for counter in counters)
+    adjudicated = {reason: sum(counter[3][reason] for counter in counters) for reason in adjudication_stage.REASONS}
+
+    assert (white_wins + black_wins + draws) == games, "Results don't add up to total game count."
+
+    return white_wins, black_wins, draws, adjudicated
 
 def main() -> None:
     # parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("--games", type=int, required=True)
+    parser.add_argument("--games", type=int, help="required, except for --connect")
     parser.add_argument("--engine", type=str, default="lc0")
-    parser.add_argument("--file_type", type=str, default="pgn", choices=["pgn", "plain"])
+    parser.add_argument("--file_type", type=str, default="pgn", choices=["pgn", "plain", "bin", "cols"])
     parser.add_argument("--nodes", type=int, default=0)
     parser.add_argument("--depth", type=int, default=0)
     parser.add_argument("--multipv", type=int, default=1)
     parser.add_argument("--mode", type=str, default="random", choices=["softmax", "random", "random-multipv"])
     parser.add_argument("--book", type=str)
     parser.add_argument("--min_ply", type=int, default=15)
+    parser.add_argument("--compress", type=str, choices=["gz", "zst"], help="compress the pgn/plain/bin output")
+    parser.add_argument("--compress_level", type=int)
+    parser.add_argument("--compress_threads", type=int, default=0, help="zstd compression threads, -1 for all cores")
+    parser.add_argument("--flush_seconds", type=int, default=10, help="write buffered games at least this often")
+    parser.add_argument("--rotate_mb", type=int, default=0, help="cut the output into shards of about this many uncompressed megabytes, 0 is off")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1, help="games in flight per process (asyncio driver when > 1), at most --engines of them play at once")
+    parser.add_argument("--engines", type=int, default=1, help="uci engines in the pool of the asyncio driver, a game keeps its engine until it's over")
+    parser.add_argument("--option", type=str, nargs="*", default=[], help="uci options of every engine, NAME=VALUE (Hash, Threads, Backend, ...)")
+    parser.add_argument("--info", type=str, default="lean", choices=sorted(INFO_PROFILES), help="info the engine searches are parsed for, lean is score, pv and search stats")
+    parser.add_argument("--shared_engine", action="store_true", help="one engine plays both colors in the sequential driver, half the engine memory")
+    parser.add_argument("--dedup", type=str, choices=["exact", "bloom"], help="drop positions already written in this run")
+    parser.add_argument("--dedup_capacity", type=int, default=10000000, help="bloom filter size, or in-memory keys before spilling")
+    parser.add_argument("--dedup_spill", type=str, help="spill exact dedup keys to disk in this directory")
+    parser.add_argument("--resign_count", type=int, default=0, help="adjudicate a loss after this many moves of a side at or below -resign_score, 0 is off")
+    parser.add_argument("--resign_score", type=int, default=700)
+    parser.add_argument("--draw_count", type=int, default=0, help="adjudicate a draw after this many moves of both sides within draw_score, 0 is off")
+    parser.add_argument("--draw_score", type=int, default=10)
+    parser.add_argument("--draw_ply", type=int, default=0, help="earliest ply for draw adjudication")
+    parser.add_argument("--max_ply", type=int, default=0, help="stop games at this ply and score them from the last eval, 0 is off")
+    parser.add_argument("--cache_size", type=int, default=0, help="keep this many analyses in memory and reuse them for repeated positions, 0 is off")
+    parser.add_argument("--cache_file", type=str, help="sqlite analysis store shared across runs and workers")
+    parser.add_argument("--metrics", type=str, help="write throughput and per-phase timings to this file")
+    parser.add_argument("--metrics_format", type=str, default="jsonl", choices=["jsonl", "prom"], help="json lines, or a prometheus textfile (one per worker)")
+    parser.add_argument("--metrics_interval", type=int, default=30, help="seconds between metrics reports")
+    parser.add_argument("--profile", type=str, help="run the game loop under cProfile and dump the stats to this file")
+    parser.add_argument("--serve", type=str, help="coordinate a distributed run on HOST:PORT, workers play the games")
+    parser.add_argument("--connect", type=str, help="play batches for the coordinator at HOST:PORT")
+    parser.add_argument("--batch_games", type=int, default=10, help="games per batch of a distributed run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first batch of a distributed run")
+    parser.add_argument("--worker_timeout", type=int, default=600, help="seconds without a game before a worker is given up")
+    parser.add_argument("--run_dir", type=str, help="write the output, its checkpoints and the run's settings to this directory")
+    parser.add_argument("--resume", type=str, help="continue the interrupted run in this run directory")
 
     # initialize arguments
     args = parser.parse_args()
 
+    # a resumed run takes its settings and its output name from its run directory
+    if args.resume:
+        run = checkpoint.read_run(args.resume)
+        if run["finished"]:
+            print(f"RESUME:", args.resume, "is already finished")
+            return
+        args = argparse.Namespace(**dict(run["args"], run_dir=args.resume, resume=args.resume))
+
+    # worker of a distributed run, the coordinator sends the settings with every batch
+    if args.connect:
+        name = f"{socket.gethostname()}:{os.getpid()}"
+        engine_spec = (dict(option.split("=", 1) for option in args.option), args.info, args.shared_engine)
+        player = BatchPlayer(args.engine, max(1, args.engines), max(1, args.concurrency), args.book, engine_spec)
+        try:
+            distributed.run_worker(distributed.parse_address(args.connect), name, player.play)
+        finally:
+            player.close()
+        return
+    # not an assert, python -O (run.sh) strips those
+    if not args.games:
+        parser.error("--games is required except with --connect")
+
     games = args.games
     engine = args.engine
     file_type = args.file_type
@@ -371,14 +867,37 @@ def main() -> None:
     multipv = args.multipv if (args.multipv > 1 and (args.mode == "random-multipv" or args.mode == "softmax")) else 10
     mode = args.mode
     base_name = "games-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    file_name = base_name + ".pgn" if file_type == "pgn" else base_name + ".plain"
+    file_name = base_name + "." + file_type
+    # a column store is a directory of raw columns, it isn't compressed
+    if args.compress and file_type != "cols":
+        file_name += "." + args.compress
+    # output and checkpoints of a journaled run are kept together
+    if args.resume:
+        file_name = os.path.join(args.run_dir, run["output"])
+    elif args.run_dir:
+        os.makedirs(args.run_dir, exist_ok=True)
+        file_name = os.path.join(args.run_dir, file_name)
+        checkpoint.write_run(args.run_dir, args, file_name)
+    journal = args.run_dir != None
+    compressed.configure(args.compress_level, args.compress_threads)
     min_ply = args.min_ply
+    workers = max(1, min(args.workers, games))
+    concurrency = max(1, args.concurrency)
+    engines = max(1, args.engines)
+    # dedup works on training records, not on pgn output
+    dedup_spec = (args.dedup if file_type != "pgn" else None, args.dedup_capacity, args.dedup_spill)
+    metrics_spec = (args.metrics, args.metrics_format, args.metrics_interval)
+    sink_spec = (args.flush_seconds, args.rotate_mb * 1024 * 1024)
+    engine_spec = (dict(option.split("=", 1) for option in args.option), args.info, args.shared_engine)
+    # cached analyses only count for this engine with these options
+    cache_spec = (args.cache_size, args.cache_file, analysiscache.engine_fingerprint(engine, engine_spec[0]))
+    # adjudication starts counting once the random opening is over
+    adjudication = adjudication_stage.Adjudication(args.resign_count, args.resign_score, args.draw_count, args.draw_score, args.draw_ply, args.max_ply, min_ply)
 
     # initialize book
     if args.book:
-        reader = chess.polyglot.open_reader(args.book)
-        if reader:
-            print(f"BOOK:", args.book)
+        reader = bookindex.BookIndex(args.book)
+        print(f"BOOK:", args.book, f"({len(reader)} entries)")
     else:
         reader = None
         print(f"BOOK: Using no book")
@@ -386,15 +905,74 @@ def main() -> None:
     # print the options you've set
     print(f"NUM OF GAMES:", games)
     print(f"ENGINE:", engine)
+    if engine_spec[0]:
+        print(f"ENGINE_OPTIONS:", " ".join(f"{name}={value}" for name, value in engine_spec[0].items()))
+    if args.shared_engine and concurrency == 1:
+        print(f"SHARED_ENGINE:", "one engine plays both colors")
+    print(f"INFO:", args.info)
     print(f"NODES:", nodes)
     print(f"DEPTH:", depth)
     print(f"MULTIPV:", multipv)
     print(f"MODE:", mode)
     print(f"FILE_TYPE:", file_type)
     print(f"OUTPUT_NAME:", file_name)
+    if args.rotate_mb:
+        print(f"ROTATE:", f"shards of {args.rotate_mb} MB,", sink.shard_name(file_name, 0), "..." if workers == 1 else "... per worker")
+    print(f"WORKERS:", workers)
+    if concurrency > 1:
+        print(f"CONCURRENCY:", concurrency)
+        print(f"ENGINES:", engines)
+    if dedup_spec[0]:
+        print(f"DEDUP:", args.dedup)
+    if args.resign_count:
+        print(f"RESIGN:", f"count={args.resign_count} score={args.resign_score}")
+    if args.draw_count:
+        print(f"DRAW:", f"count={args.draw_count} score={args.draw_score} ply={args.draw_ply}")
+    if args.max_ply:
+        print(f"MAX_PLY:", args.max_ply)
+    if args.cache_size or args.cache_file:
+        print(f"CACHE:", args.cache_size or analysiscache.DEFAULT_SIZE, "entries", f"({args.cache_file})" if args.cache_file else "")
+    if args.metrics:
+        print(f"METRICS:", args.metrics, f"({args.metrics_format}, every {args.metrics_interval}s)")
+    if journal:
+        print(f"RUN_DIR:", args.run_dir, "(resumed)" if args.resume else "")
 
     # run self-play games
-    play(games, engine, file_type, nodes, depth, multipv, mode, file_name, reader, min_ply)
+    if args.serve:
+        if reader:
+            reader.close()
+        settings = {"file_type": file_type, "nodes": nodes, "depth": depth, "multipv": multipv, "mode": mode, "min_ply": min_ply, "book": args.book, "adjudication": vars(adjudication)}
+        white_wins, black_wins, draws, adjudicated = distributed.serve(distributed.parse_address(args.serve), games, args.batch_games, settings, file_name, file_type, args.seed, args.worker_timeout)
+    elif workers > 1:
+        # each worker opens its own book reader
+        if reader:
+            reader.close()
+        white_wins, black_wins, draws, adjudicated = play_parallel(workers, games, engine, engines, concurrency, file_type=file_type, nodes=nodes, depth=depth, multipv=multipv, mode=mode, file_name=file_name, book=args.book, min_ply=min_ply, dedup_spec=dedup_spec, metrics_spec=metrics_spec, profile_file=args.profile, adjudication=adjudication, cache_spec=cache_spec, sink_spec=sink_spec, journal=journal, engine_spec=engine_spec)
+    else:
+        dedup = dedup_stage.open_dedup(*dedup_spec)
+        metrics = metrics_stage.open_metrics(*metrics_spec)
+        cache = analysiscache.open_cache(*cache_spec)
+        settings = dict(file_type=file_type, nodes=nodes, depth=depth, multipv=multipv, mode=mode, file_name=file_name, book_reader=reader, min_ply=min_ply, dedup=dedup, metrics=metrics, adjudication=adjudication, cache=cache, sink_spec=sink_spec, journal=journal, engine_spec=engine_spec)
+        if concurrency > 1:
+            white_wins, black_wins, draws, adjudicated = metrics_stage.run_profiled(args.profile, play_concurrent, games, engine, engines, concurrency, **settings)
+        else:
+            white_wins, black_wins, draws, adjudicated = metrics_stage.run_profiled(args.profile, play, games, engine, **settings)
+        # every round is played, like the part checkpoints of --workers
+        if journal:
+            checkpoint.remove_checkpoint(file_name)
+        if dedup:
+            print(dedup.summary())
+            dedup.close()
+        if metrics.file_name:
+            print(metrics.summary())
+            metrics.close()
+        if cache:
+            print(cache.summary())
+            cache.close()
+
+    print_results(games, white_wins, black_wins, draws, adjudicated)
+    if journal:
+        checkpoint.write_run(args.run_dir, args, file_name, True)
 
     print(f"Done!")
 
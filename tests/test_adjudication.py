@@ -0,0 +1,35 @@
+# a game that ends on the move that reaches an adjudication rule is scored as played
+import os
+import sys
+import chess
+import chess.engine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import adjudication
+
+# play the moves until a verdict, every move is scored score for its mover
+def play(rules, moves, score=0):
+    board = chess.Board()
+    game_adjudication = rules.new_game()
+    verdict = None
+    for move in moves:
+        board.push_san(move)
+        verdict = game_adjudication.update(board, chess.engine.PovScore(chess.engine.Cp(score), not board.turn))
+        if verdict:
+            break
+    return board, verdict
+
+def test_mate_at_max_ply():
+    board, verdict = play(adjudication.Adjudication(max_ply=4), ["f3", "e5", "g4", "Qh4#"])
+    assert board.is_checkmate()
+    assert verdict == None
+
+def test_max_ply():
+    board, verdict = play(adjudication.Adjudication(max_ply=4), ["e4", "e5", "Nf3", "Nc6", "Bb5"])
+    assert board.ply() == 4
+    assert verdict == ("max_ply", None)
+
+def test_repetition_at_max_ply():
+    board, verdict = play(adjudication.Adjudication(max_ply=8), ["Nf3", "Nf6", "Ng1", "Ng8", "Nf3", "Nf6", "Ng1", "Ng8"])
+    assert board.can_claim_threefold_repetition()
+    assert verdict == None
@@ -0,0 +1,29 @@
+# a shared analysis store only hands out analyses of the same engine, net and options
+import os
+import sys
+import chess
+import chess.engine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import analysiscache
+
+RESULTS = [{"score": chess.engine.PovScore(chess.engine.Cp(12), chess.WHITE), "pv": [chess.Move.from_uci("e2e4")], "nodes": 10, "depth": 1, "time": 0.0}]
+
+def lookup(store, fingerprint):
+    cache = analysiscache.open_cache(0, store, fingerprint)
+    results = cache.get(chess.Board(), chess.engine.Limit(nodes=10), 1, None)
+    cache.close()
+    return results
+
+def test_store_keyed_on_engine(tmp_path):
+    store = str(tmp_path / "analysis.db")
+    fingerprint = analysiscache.engine_fingerprint("sf", {"EvalFile": "a.nnue", "Hash": "8"})
+    cache = analysiscache.open_cache(0, store, fingerprint)
+    cache.put(chess.Board(), chess.engine.Limit(nodes=10), 1, None, RESULTS)
+    cache.close()
+
+    assert lookup(store, fingerprint)[0]["score"].white() == chess.engine.Cp(12)
+    # option order doesn't matter
+    assert lookup(store, analysiscache.engine_fingerprint("sf", {"Hash": "8", "EvalFile": "a.nnue"})) != None
+    assert lookup(store, analysiscache.engine_fingerprint("sf", {"EvalFile": "b.nnue", "Hash": "8"})) == None
+    assert lookup(store, analysiscache.engine_fingerprint("lc0", {"EvalFile": "a.nnue", "Hash": "8"})) == None
@@ -0,0 +1,34 @@
+# the gauntlet's sprt stops a clearly weaker or stronger net before --max_games
+# mockuci.py plays worse the larger the jitter in its net file, its default net has 61,
+# one with 2000 plays close to random and is decided in a few pairs whatever the game order
+import os
+import re
+import subprocess
+import sys
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+GAUNTLET = os.path.join(TESTS, "..", "gauntlet.py")
+MOCKUCI = os.path.join(TESTS, "..", "mockuci.py")
+BOOK = os.path.join(TESTS, "..", "books", "unbal4moves.bin")
+
+def net(tmp_path, name, noise) -> str:
+    net_name = tmp_path / name
+    net_name.write_text(f"{noise}\n")
+    return str(net_name)
+
+# (games, status) of the only net of a gauntlet with the default sprt bounds
+def gauntlet(*options) -> tuple:
+    output = subprocess.run([sys.executable, GAUNTLET, "--engine", MOCKUCI, "--nodes", "1", "--concurrency", "4", "--max_games", "200",
+                             "--book", BOOK, "--seed", "1", *options], check=True, capture_output=True, text=True).stdout
+    games, status = re.findall(r"(\d+) games .* (H0|H1|max_games)$", output.split("Results:")[1], re.M)[0]
+    return int(games), status
+
+def test_weaker_net_stops_early(tmp_path):
+    games, status = gauntlet("--nets", net(tmp_path, "weak.nnue", 2000))
+    assert status == "H0"
+    assert games < 200
+
+def test_stronger_net_stops_early(tmp_path):
+    games, status = gauntlet("--nets", net(tmp_path, "strong.nnue", 1), "--baseline", net(tmp_path, "weak.nnue", 2000))
+    assert status == "H1"
+    assert games < 200
@@ -0,0 +1,46 @@
+# parity of pgntoplain.py's --fast visitor with the game tree path
+# data/parity.pgn has [%eval] comments with mate scores for both sides,
+# en passant, both castlings, promotions and underpromotions and a side line
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+PGNTOPLAIN = os.path.join(TESTS, "..", "nnue", "pgntoplain.py")
+PGN = os.path.join(TESTS, "data", "parity.pgn")
+
+def convert(output, file_type, *options, pgn=PGN) -> bytes:
+    subprocess.run([sys.executable, PGNTOPLAIN, "--pgn", str(pgn), "--output", str(output), "--format", file_type, *options], check=True, capture_output=True)
+    with open(output, "rb") as output_file:
+        return output_file.read()
+
+@pytest.mark.parametrize("file_type", ["plain", "bin"])
+def test_fast_matches_tree(tmp_path, file_type):
+    tree = convert(tmp_path / f"tree.{file_type}", file_type)
+    fast = convert(tmp_path / f"fast.{file_type}", file_type, "--fast")
+    assert tree
+    assert fast == tree
+
+# --shard_mb 0 makes every game a shard of its own
+@pytest.mark.parametrize("file_type", ["plain", "bin"])
+def test_fast_jobs_matches_tree(tmp_path, file_type):
+    tree = convert(tmp_path / f"tree.{file_type}", file_type)
+    fast = convert(tmp_path / f"fast.{file_type}", file_type, "--fast", "--jobs", "2", "--shard_mb", "0")
+    assert fast == tree
+
+# a compressed pgn is a single shard, streamed rather than read into memory
+def test_compressed_jobs_matches_tree(tmp_path):
+    pgn = tmp_path / "parity.pgn.gz"
+    with open(PGN, "rb") as pgn_file, gzip.open(pgn, "wb") as gz_file:
+        shutil.copyfileobj(pgn_file, gz_file)
+    tree = convert(tmp_path / "tree.bin", "bin")
+    fast = convert(tmp_path / "fast.bin", "bin", "--fast", "--jobs", "2", pgn=pgn)
+    assert fast == tree
+
+def test_mainline_only(tmp_path):
+    plain = convert(tmp_path / "tree.plain", "plain").decode()
+    # a record ends with an "e" line, the side line of the third game is left out
+    assert plain.splitlines().count("e") == 30 + 30 + 12
@@ -0,0 +1,32 @@
+# shuffle.py merges more runs than --fan_in in levels, the output is still a
+# permutation of the input, for .plain records kept as offsets into one buffer too
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nnue"))
+import shuffle
+
+def plain_records(count) -> list:
+    return [f"fen 8/8/8/8/8/8/8/K6k w - - 0 {i}\nmove a1a2\nscore {i}\nply {i}\nresult 0\ne\n".encode() for i in range(count)]
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_merge_levels(tmp_path, binary):
+    records = [os.urandom(40) for _ in range(1000)] if binary else plain_records(1000)
+    # 7 runs of up to 150 records
+    runs = []
+    for run in range(7):
+        run_name = str(tmp_path / f"run{run}")
+        runs.append(shuffle.shuffle_chunk((f"in.{'bin' if binary else 'plain'}", None, None, b"".join(records[run * 150:(run + 1) * 150]), run_name, run)))
+
+    runs = shuffle.reduce_runs(runs, str(tmp_path), binary, 0, block=64, fan_in=2)
+    assert len(runs) == 2
+    output = str(tmp_path / "output")
+    assert shuffle.merge_runs(runs, output, binary, 1, block=64) == 1000
+
+    with open(output, "rb") as output_file:
+        data = output_file.read()
+    merged = [data[i:i + 40] for i in range(0, len(data), 40)] if binary else [record + b"e\n" for record in data.split(b"e\n")[:-1]]
+    assert sorted(merged) == sorted(records)
+    assert merged != records